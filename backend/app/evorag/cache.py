@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from utils import md5
+except ImportError:
+    from .utils import md5
+
+
+class SqliteCache:
+    def __init__(self, file_path, max_memory_items=10000, max_items=200000, evict_interval=1000, bypass=False):
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.file_path = file_path
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, accessed REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.memory = OrderedDict()
+        self.accessed = {}
+        self.max_memory_items = max_memory_items
+        self.max_items = max_items
+        self.evict_interval = evict_interval
+        self.writes = 0
+        self.bypass = bypass
+
+    @staticmethod
+    def encode(value):
+        return value
+
+    @staticmethod
+    def decode(value):
+        return value
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    async def get_many(self, keys):
+        if self.bypass:
+            return {}
+
+        res, misses = {}, []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                res[key] = self.memory[key]
+            else:
+                misses.append(key)
+
+        if misses:
+            for key, value in (await asyncio.to_thread(self.read, misses)).items():
+                res[key] = value
+                self.remember(key, value)
+        return res
+
+    def read(self, keys):
+        res = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.conn.execute(f'SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(batch))})',
+                                         batch)
+                for key, value in rows:
+                    res[key] = self.decode(value)
+                    self.accessed[key] = time.time()
+        return res
+
+    def touch(self):
+        if self.accessed:
+            self.conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                                  [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed = {}
+
+    async def set_many(self, items):
+        if self.bypass:
+            return
+        for key, value in items:
+            self.remember(key, value)
+        await asyncio.to_thread(self.write, items)
+
+    def write(self, items):
+        now = time.time()
+        with self.lock:
+            self.touch()
+            self.conn.executemany('INSERT OR REPLACE INTO cache (key, value, accessed) VALUES (?, ?, ?)',
+                                  [(key, self.encode(value), now) for key, value in items])
+            self.writes += len(items)
+            if self.writes >= self.evict_interval:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        self.writes = 0
+        if self.max_items is not None:
+            self.conn.execute('DELETE FROM cache WHERE key IN '
+                              '(SELECT key FROM cache ORDER BY accessed LIMIT MAX(0, (SELECT COUNT(*) FROM cache) - ?))',
+                              (self.max_items,))
+
+    def close(self):
+        with self.lock:
+            self.touch()
+            self.evict()
+            self.conn.commit()
+            self.conn.close()
+
+
+class EmbeddingCache(SqliteCache):
+    @staticmethod
+    def encode(value):
+        return np.asarray(value, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def decode(value):
+        return np.frombuffer(value, dtype=np.float32)
+
+    async def get(self, model, texts):
+        keys = [md5(text, salt=model) for text in texts]
+        res = await self.get_many(keys)
+        return [res.get(key) for key in keys]
+
+    async def set(self, model, texts, embeddings):
+        await self.set_many([(md5(text, salt=model), self.decode(self.encode(embedding)))
+                       for text, embedding in zip(texts, embeddings)])
+
+
+class CompletionCache(SqliteCache):
+    @staticmethod
+    def key(model, messages, kwargs):
+        return md5(json.dumps([model, messages, kwargs], sort_keys=True, ensure_ascii=False, default=str))
+
+    async def get(self, key):
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key, content):
+        await self.set_many([(key, content)])
+
+
+if __name__ == '__main__':
+    async def main():
+        cache = EmbeddingCache(os.path.join('temp', 'cache_embedding.db'))
+        await cache.set('embedding-3', ['Hello', 'World'], np.random.rand(2, 4))
+        print(await cache.get('embedding-3', ['Hello', 'World', 'Missing']))
+        cache.close()
+
+        cache = CompletionCache(os.path.join('temp', 'cache_completion.db'), max_items=1, evict_interval=1)
+        key = cache.key('glm-4-plus', [{'role': 'user', 'content': 'Hello'}], {})
+        await cache.set(key, 'Hello, World!')
+        print(await cache.get(key))
+        cache.close()
+
+    asyncio.run(main())
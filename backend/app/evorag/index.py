@@ -0,0 +1,121 @@
+from collections import Counter
+
+import numpy as np
+
+from utils import tokenizer
+
+
+class IVFIndex:
+    def __init__(self, nlist=None, nprobe=8, min_size=20000, rebuild_ratio=0.2, max_iter=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.rebuild_ratio = rebuild_ratio
+        self.max_iter = max_iter
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        self.centroids, self.order, self.offsets = None, None, None
+        self.size = 0
+        self.stale = set()
+
+    def update(self, rows):
+        self.stale.update(int(i) for i in rows if i < self.size)
+
+    @staticmethod
+    def assign(matrix, centroids, batch_size=4096):
+        return np.concatenate([np.argmax(matrix[i:i + batch_size] @ centroids.T, axis=1)
+                               for i in range(0, len(matrix), batch_size)])
+
+    def build(self, matrix):
+        rng = np.random.default_rng(self.seed)
+        nlist = min(self.nlist or int(np.sqrt(len(matrix))), len(matrix))
+        sample = matrix[np.sort(rng.choice(len(matrix), min(len(matrix), 64 * nlist), replace=False))]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+        for _ in range(self.max_iter):
+            labels = self.assign(sample, centroids)
+            order = np.argsort(labels, kind='stable')
+            clusters, starts = np.unique(labels[order], return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids[clusters] = sums / np.where(norms == 0, 1, norms)
+
+        labels = self.assign(matrix, centroids)
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.searchsorted(labels[self.order], np.arange(nlist + 1))
+        self.centroids, self.size, self.stale = centroids, len(matrix), set()
+
+    def search(self, matrix, queries, top_k):
+        if len(matrix) < self.min_size:
+            return None
+        if self.centroids is None or self.size > len(matrix) or \
+                len(matrix) - self.size + len(self.stale) > self.rebuild_ratio * self.size:
+            self.build(matrix)
+
+        tail = np.concatenate([np.arange(self.size, len(matrix)), np.fromiter(self.stale, dtype=np.int64)])
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        res = []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe] + [tail])
+            if self.stale:
+                candidates = np.unique(candidates)
+            scores = matrix[candidates] @ query
+            k = min(top_k, len(candidates))
+            index = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=np.int64)
+            index = index[np.argsort(-scores[index])]
+            res.append((candidates[index], scores[index]))
+        return res
+
+
+class BM25Index:
+    def __init__(self, texts, k1=1.5, b=0.75):
+        tokens = tokenizer.encode_batch(texts)
+        lengths = np.array([len(i) for i in tokens], dtype=np.float32)
+        norms = k1 * (1 - b + b * lengths / max(lengths.mean(), 1)) if len(tokens) else lengths
+
+        postings = {}
+        for row, terms in enumerate(tokens):
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(tf)
+
+        self.size = len(tokens)
+        self.postings = {}
+        for term, (rows, tfs) in postings.items():
+            rows, tfs = np.array(rows), np.array(tfs, dtype=np.float32)
+            idf = np.log(1 + (self.size - len(rows) + 0.5) / (len(rows) + 0.5))
+            self.postings[term] = (rows, idf * tfs * (k1 + 1) / (tfs + norms[rows]))
+
+    def score(self, text):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenizer.encode(text)):
+            if term in self.postings:
+                rows, weights = self.postings[term]
+                scores[rows] += weights
+        return scores
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((500, 128)).astype(np.float32)
+    matrix = centers[rng.integers(500, size=50000)] + 0.5 * rng.standard_normal((50000, 128)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = matrix[:100] + 0.1 * rng.standard_normal((100, 128)).astype(np.float32)
+
+    index = IVFIndex(nprobe=16)
+    index.build(matrix)
+    start = time.perf_counter()
+    res = index.search(matrix, queries, 10)
+    print(f'ivf {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    exact = np.argsort(-(queries @ matrix.T), axis=1)[:, :10]
+    print(f'exact {time.perf_counter() - start:.3f}s')
+    print('recall@10', np.mean([len(set(i) & set(j)) / 10 for (i, _), j in zip(res, exact)]))
@@ -1,10 +1,18 @@
+import asyncio
 import os
+from contextlib import nullcontext
 
+import httpx
 import numpy as np
 from openai import APIConnectionError, RateLimitError
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
+try:
+    from cache import CompletionCache, EmbeddingCache
+except ImportError:
+    from .cache import CompletionCache, EmbeddingCache
+
 
 def openai_retry(func):
     return retry(stop=stop_after_attempt(5),
@@ -12,18 +20,58 @@ def openai_retry(func):
                  retry=retry_if_exception_type((APIConnectionError, RateLimitError)))(func)
 
 
-def get_openai_async_client(base_url=None, api_key=None):
+openai_async_clients = {}
+
+
+def get_openai_async_client(base_url=None, api_key=None, pool_size=None):
     if not api_key:
         api_key = os.environ.get("OPENAI_API_KEY")
-    return AsyncOpenAI(api_key=api_key, base_url=base_url)
+    if pool_size is None:
+        pool_size = int(os.environ.get("OPENAI_POOL_SIZE", 64))
+
+    loop = asyncio.get_running_loop()
+    key = (base_url, api_key)
+    if key in openai_async_clients:
+        client_loop, client = openai_async_clients[key]
+        if client_loop is loop and not client.is_closed():
+            return client
+
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60)
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=DefaultAsyncHttpxClient(limits=limits))
+    openai_async_clients[key] = (loop, client)
+    return client
+
+
+async def close_openai_async_clients():
+    loop = asyncio.get_running_loop()
+    for client_loop, client in openai_async_clients.values():
+        if client_loop is loop:
+            await client.close()
+    openai_async_clients.clear()
+
+
+model_caches = {}
+
+
+def get_model_cache(name, cache_type):
+    if name not in model_caches:
+        cache_dir = os.environ.get('EVORAG_CACHE_DIR', 'temp')
+        bypass = os.environ.get(f'{name.upper()}_CACHE_BYPASS', '').lower() in ('1', 'true', 'yes')
+        model_caches[name] = cache_type(os.path.join(cache_dir, f'cache_{name}.db'), bypass=bypass)
+    return model_caches[name]
+
+
+def close_model_caches():
+    for cache in model_caches.values():
+        cache.close()
+    model_caches.clear()
 
 
 @openai_retry
 async def openai_complete(model, user_prompt, system_prompt=None, history=None,
-                          base_url=None, api_key=None, **kwargs):
+                          base_url=None, api_key=None, scheduler=None, priority=1, cache=None, **kwargs):
     if history is None:
         history = []
-    client = get_openai_async_client(base_url, api_key)
 
     messages = []
     if system_prompt:
@@ -31,23 +79,46 @@ async def openai_complete(model, user_prompt, system_prompt=None, history=None,
     messages.extend(history)
     messages.append({"role": "user", "content": user_prompt})
 
-    response = await client.chat.completions.create(model=model, messages=messages, **kwargs)
+    if cache is not None:
+        key = cache.key(model, messages, kwargs)
+        content = await cache.get(key)
+        if content is not None:
+            return content
+
+    client = get_openai_async_client(base_url, api_key)
+    limit = nullcontext() if scheduler is None else \
+        scheduler.limit(scheduler.cost([i['content'] for i in messages], kwargs.get('max_tokens')), priority)
+    async with limit:
+        response = await client.chat.completions.create(model=model, messages=messages, **kwargs)
     content = response.choices[0].message.content
-    await client.close()
+    if cache is not None and content is not None:
+        await cache.set(key, content)
     return content
 
 
 @openai_retry
-async def openai_embedding(model, text, base_url=None, api_key=None, **kwargs):
-    client = get_openai_async_client(base_url, api_key)
+async def openai_embedding(model, text, base_url=None, api_key=None, scheduler=None, priority=1, cache=None,
+                           **kwargs):
+    texts = [text] if isinstance(text, str) else list(text)
+    embeddings = await cache.get(model, texts) if cache is not None else [None] * len(texts)
+    misses = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    if not misses:
+        return np.array(embeddings)
 
-    response = await client.embeddings.create(model=model, input=text, **kwargs)
-    embeddings = np.array([i.embedding for i in response.data])
-    await client.close()
+    client = get_openai_async_client(base_url, api_key)
+    limit = nullcontext() if scheduler is None else scheduler.limit(scheduler.cost(misses), priority)
+    async with limit:
+        response = await client.embeddings.create(model=model, input=misses, **kwargs)
+    response = {t: i.embedding for t, i in zip(misses, response.data)}
+    if cache is not None:
+        await cache.set(model, misses, [response[t] for t in misses])
+
+    embeddings = np.array([response[t] if e is None else e for t, e in zip(texts, embeddings)])
     return embeddings
 
 
 async def deepseek_v3(user_prompt, system_prompt=None, history=None, **kwargs):
+    kwargs.setdefault('cache', get_model_cache('completion', CompletionCache))
     return await openai_complete(model='deepseek-chat',
                                  base_url='https://api.deepseek.com',
                                  api_key=os.getenv('DEEPSEEK_API_KEY'),
@@ -58,6 +129,7 @@ async def deepseek_v3(user_prompt, system_prompt=None, history=None, **kwargs):
 
 
 async def glm_4_plus(user_prompt, system_prompt=None, history=None, **kwargs):
+    kwargs.setdefault('cache', get_model_cache('completion', CompletionCache))
     return await openai_complete(model='glm-4-plus',
                                  base_url='https://open.bigmodel.cn/api/paas/v4',
                                  api_key=os.getenv('ZHIPUAI_API_KEY'),
@@ -68,6 +140,7 @@ async def glm_4_plus(user_prompt, system_prompt=None, history=None, **kwargs):
 
 
 async def embedding_3(text, **kwargs):
+    kwargs.setdefault('cache', get_model_cache('embedding', EmbeddingCache))
     return await openai_embedding(model='embedding-3',
                                   base_url='https://open.bigmodel.cn/api/paas/v4',
                                   api_key=os.getenv('ZHIPUAI_API_KEY'),
@@ -76,11 +149,15 @@ async def embedding_3(text, **kwargs):
 
 
 if __name__ == '__main__':
-    import asyncio
     from dotenv import load_dotenv
 
     load_dotenv()
 
-    # print(asyncio.run(deepseek_v3('Hello')))
-    print(asyncio.run(glm_4_plus('Hello')))
-    print(asyncio.run(embedding_3('Hello')))
+    async def main():
+        # print(await deepseek_v3('Hello'))
+        print(await glm_4_plus('Hello'))
+        print(await embedding_3('Hello'))
+        await close_openai_async_clients()
+        close_model_caches()
+
+    asyncio.run(main())
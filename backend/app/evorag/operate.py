@@ -1,57 +1,341 @@
 import asyncio
 import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 
 import numpy as np
 
 from prompt import format_template, PROMPTS
-from utils import AwaitNone, lock1, lock2, create_message, list_to_dict
-from utils import cosine_similarity
+from scheduler import Scheduler, get_scheduler
+from utils import AwaitNone, create_message, list_to_dict
+from utils import similarity_groups
 from utils import logger
 from utils import tokenizer, md5
 
 
-def text_chunking(docs, max_tokens=1024, overlap_tokens=128):
-    docs = list(docs.items())
-    ids, contents = zip(*[(doc[0], doc[1]['content']) for doc in docs])
+SENTENCE_PATTERN = re.compile(r'(?<=[。！？；!?;\n])|(?<=\.)(?=\s)')
+OVERLAP_TOKENS = {'token': 128, 'sentence': 32}
+
+
+def split_sentences(pieces):
+    rest = ''
+    for piece in pieces:
+        sentences = SENTENCE_PATTERN.split(rest + piece)
+        rest = sentences.pop()
+        yield from (sentence for sentence in sentences if sentence)
+    if rest:
+        yield rest
+
+
+def token_windows(pieces, max_tokens=1024, overlap_tokens=128):
+    step = max_tokens - overlap_tokens
+    buffer = []
+    for piece in pieces:
+        buffer.extend(tokenizer.encode(piece))
+        start = 0
+        while len(buffer) - start >= max_tokens:
+            yield tokenizer.decode(buffer[start:start + max_tokens]), max_tokens
+            start += step
+        del buffer[:start]
+
+    for start in range(0, len(buffer), step):
+        window = buffer[start:start + max_tokens]
+        yield tokenizer.decode(window), len(window)
+
+
+def sentence_windows(pieces, max_tokens=1024, overlap_tokens=32):
+    window, size, fresh = [], 0, False
+
+    def flush():
+        content = ''.join(sentence for sentence, _ in window)
+        return [(content, size)] if fresh and content.strip() else []
+
+    for sentence in split_sentences(pieces):
+        tokens = len(tokenizer.encode(sentence))
+        if tokens > max_tokens:
+            yield from flush()
+            window, size, fresh = [], 0, False
+            yield from token_windows([sentence], max_tokens, overlap_tokens)
+            continue
+
+        if size + tokens > max_tokens:
+            yield from flush()
+            while window and (size > overlap_tokens or size + tokens > max_tokens):
+                size -= window.pop(0)[1]
+            fresh = False
+        window.append((sentence, tokens))
+        size += tokens
+        fresh = True
+    yield from flush()
+
+
+def chunk_overlap(max_tokens, overlap_tokens=None, mode='token'):
+    overlap_tokens = OVERLAP_TOKENS.get(mode, 128) if overlap_tokens is None else overlap_tokens
+    if overlap_tokens >= max_tokens:
+        raise ValueError(f'overlap_tokens ({overlap_tokens}) must be smaller than max_tokens ({max_tokens})')
+    return overlap_tokens
+
+
+def chunk_document(id, content, max_tokens=1024, overlap_tokens=None, mode='token'):
+    pieces = [content] if isinstance(content, str) else content
+    windows = sentence_windows if mode == 'sentence' else token_windows
+    overlap_tokens = chunk_overlap(max_tokens, overlap_tokens, mode)
+    for index, (content, size) in enumerate(windows(pieces, max_tokens, overlap_tokens)):
+        chunk = {'doc': id,
+                 'index': index,
+                 'content': content.strip(),
+                 'size': size}
+        yield md5(chunk['content'], prefix='chunk'), chunk
+
+
+def iter_chunks(docs, max_tokens=1024, overlap_tokens=None, mode='token'):
+    docs = docs.items() if isinstance(docs, dict) else docs
+    for id, doc in docs:
+        yield from chunk_document(id, doc['content'], max_tokens, overlap_tokens, mode)
+
+
+def text_chunking(docs, max_tokens=1024, overlap_tokens=None, mode='token'):
+    res = dict(iter_chunks(docs, max_tokens, overlap_tokens, mode))
+    return res
+
+
+def chunk_batch(docs, max_tokens=1024, overlap_tokens=None, mode='token'):
+    return list(iter_chunks(docs, max_tokens, overlap_tokens, mode))
+
 
-    chunks = []
-    tokens = tokenizer.encode_batch(contents)
-    for i, token in enumerate(tokens):
-        contents, sizes = [], []
-        for j in range(0, len(token), max_tokens - overlap_tokens):
-            contents.append(token[j:j + max_tokens])
-            sizes.append(min(max_tokens, len(token) - j))
+def take(iterator, n):
+    return list(islice(iterator, n))
 
-        contents = tokenizer.decode_batch(contents)
-        for j, content in enumerate(contents):
-            chunks.append({'doc': ids[i],
-                           'index': j,
-                           'content': content.strip(),
-                           'size': sizes[j]})
 
-    res = {md5(chunk['content'], prefix='chunk'): chunk for chunk in chunks}
+async def aiter_chunks(docs, max_tokens=1024, overlap_tokens=None, max_workers=None, batch_size=16,
+                       max_pending=None, executor=None, mode='token'):
+    loop = asyncio.get_running_loop()
+    overlap_tokens = chunk_overlap(max_tokens, overlap_tokens, mode)
+    docs = docs.items() if isinstance(docs, dict) else docs
+    pool = executor or ProcessPoolExecutor(max_workers)
+    max_pending = max_pending or 2 * (max_workers or os.cpu_count())
+    pending, batch = deque(), []
+
+    def submit(docs):
+        pending.append(loop.run_in_executor(pool, chunk_batch, docs, max_tokens, overlap_tokens, mode))
+
+    try:
+        for id, doc in docs:
+            if isinstance(doc['content'], str):
+                batch.append((id, {'content': doc['content']}))
+                if len(batch) >= batch_size:
+                    submit(batch)
+                    batch = []
+            else:
+                if batch:
+                    submit(batch)
+                    batch = []
+                while pending:
+                    for chunk in await pending.popleft():
+                        yield chunk
+                stream = chunk_document(id, doc['content'], max_tokens, overlap_tokens, mode)
+                while chunks := await loop.run_in_executor(None, take, stream, batch_size):
+                    for chunk in chunks:
+                        yield chunk
+
+            while len(pending) >= max_pending:
+                for chunk in await pending.popleft():
+                    yield chunk
+        if batch:
+            submit(batch)
+
+        while pending:
+            for chunk in await pending.popleft():
+                yield chunk
+    finally:
+        if executor is None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def parallel_chunking(docs, max_tokens=1024, overlap_tokens=None, max_workers=None, batch_size=16,
+                            mode='token'):
+    res = {id: chunk async for id, chunk in aiter_chunks(docs, max_tokens, overlap_tokens, max_workers, batch_size,
+                                                         mode=mode)}
     return res
 
 
-async def entity_extraction(chunks, chat_model, vector_model, vdb_ent, vdb_rel, max_rounds=0, threshold=0.8):
-    chunks = list(chunks.items())
-    global_entities, global_relations = set(), set()
-    last_ent_task, last_rel_task = AwaitNone, AwaitNone
+async def chunk_diffing(chunks, kv_chunks, full=False):
+    ids = await kv_chunks.all_keys()
+    records = dict(zip(ids, await kv_chunks.get(ids)))
+    docs = {chunk['doc'] for chunk in chunks.values()}
 
-    async def get_embeddings(objs, weight1=0.7, weight2=0.3):
-        name_embed, desc_embed = await asyncio.gather(vector_model([obj['name'] for obj in objs]),
-                                                      vector_model([obj['desc'] for obj in objs]))
-        for i, obj in enumerate(objs):
-            obj['embedding'] = weight1 * name_embed[i] + weight2 * desc_embed[i]
+    new_chunks = {id: chunk for id, chunk in chunks.items()
+                  if records.get(id, {}).get('status') != 'done'}
+    removed = [id for id, record in records.items()
+               if id not in chunks and (full or record.get('doc') in docs)]
 
-    async def get_summaries(objs, summary_tokens=128):
+    await kv_chunks.upsert({id: {'doc': chunk['doc'], 'status': 'pending'}
+                            for id, chunk in new_chunks.items() if id not in records})
+    logger.info(f'新增{len(new_chunks)}个文本块，移除{len(removed)}个文本块')
+    return new_chunks, removed
+
+
+def token_count(obj):
+    if 'tokens' not in obj:
+        obj['tokens'] = len(tokenizer.encode(obj['desc']))
+    return obj['tokens']
+
+
+def desc_fragments(obj):
+    if 'fragments' not in obj:
+        obj['fragments'] = [[None, obj['desc'], token_count(obj)]]
+    return obj['fragments']
+
+
+def set_fragments(obj, fragments):
+    obj['fragments'] = fragments
+    obj['desc'] = '\n'.join(i[1] for i in fragments)
+    obj['tokens'] = sum(i[2] + 1 for i in fragments) - 1
+
+
+def strip_fragments(objs):
+    return [{k: v for k, v in obj.items() if k not in ('fragments', 'deferred')} for obj in objs]
+
+
+async def object_embeddings(objs, vector_model, weight1=0.7, weight2=0.3, priority=Scheduler.NORMAL):
+    if not objs:
+        return
+    name_embed, desc_embed = await asyncio.gather(vector_model([obj['name'] for obj in objs], priority=priority),
+                                                  vector_model([obj['desc'] for obj in objs], priority=priority))
+    for i, obj in enumerate(objs):
+        obj['embedding'] = weight1 * name_embed[i] + weight2 * desc_embed[i]
+
+
+async def chunk_retraction(chunk_ids, kv_chunks, vector_model, vdb_ent, vdb_rel, gdb_kg=None, scheduler=None):
+    records = [record for record in await kv_chunks.get(chunk_ids) if record]
+    removed = set(chunk_ids)
+    vector_model = partial(vector_model, scheduler=scheduler or get_scheduler())
+
+    async def retract(vdb, ids):
+        objs = [obj for obj in await vdb.get(list(ids)) if obj]
+        keep, drop, changed = {}, set(), []
         for obj in objs:
-            tokens = tokenizer.encode(obj['desc'])
-            if len(tokens) > summary_tokens:
-                prompt = format_template(PROMPTS['SUMMARIZE_DESC'], name=obj['name'], desc=obj['desc'])
-                obj['desc'] = await chat_model(prompt, max_tokens=summary_tokens)
-                logger.info(f'为{obj['name']}总结了摘要')
-        await get_embeddings(objs)
+            obj['chunks'] = [i for i in obj.get('chunks', []) if i not in removed]
+            if obj['chunks']:
+                fragments = [i for i in desc_fragments(obj) if i[0] not in removed]
+                if fragments and len(fragments) < len(obj['fragments']):
+                    set_fragments(obj, fragments)
+                    changed.append(obj)
+                obj['embedding'] = np.array(obj['embedding'])
+                keep[obj['id']] = obj
+            else:
+                drop.add(obj['id'])
+        await object_embeddings(changed, vector_model)
+        return keep, drop
+
+    keep_entities, drop_entities = await retract(vdb_ent, {i for record in records for i in record.get('entities', [])})
+    keep_relations, drop_relations = await retract(vdb_rel, {i for record in records for i in record.get('relations', [])})
+    for id in [id for id, rel in keep_relations.items() if {rel['source'], rel['target']} & drop_entities]:
+        drop_relations.add(keep_relations.pop(id)['id'])
+
+    if gdb_kg is not None:
+        for id in drop_entities:
+            edges = await gdb_kg.in_edges(id) + await gdb_kg.out_edges(id)
+            drop_relations.update(e['id'] for u, v, e in edges)
+            await gdb_kg.delete_node(id)
+        for id in drop_relations:
+            await gdb_kg.delete_edge(id)
+        for ent in strip_fragments(keep_entities.values()):
+            await gdb_kg.upsert_node(ent)
+        for rel in strip_fragments(keep_relations.values()):
+            await gdb_kg.upsert_edge(rel)
+
+    if keep_entities:
+        await vdb_ent.upsert(keep_entities)
+    if keep_relations:
+        await vdb_rel.upsert(keep_relations)
+    await vdb_ent.delete(list(drop_entities))
+    await vdb_rel.delete(list(drop_relations))
+    await kv_chunks.delete(chunk_ids)
+    logger.info(f'撤回了{len(drop_entities)}个实体和{len(drop_relations)}个关系')
+
+
+async def entity_extraction(chunks, chat_model, vector_model, vdb_ent, vdb_rel, max_rounds=0, threshold=0.8,
+                            max_workers=16, max_queue_size=64, merge_batch_size=8, scheduler=None, kv_chunks=None,
+                            gdb_kg=None, checkpoint_interval=None, max_summaries=8, defer_summaries=False,
+                            max_desc_tokens=1024):
+    chunks = chunks.items() if isinstance(chunks, dict) else chunks
+    scheduler = scheduler or get_scheduler()
+    chat_model = partial(chat_model, scheduler=scheduler)
+    vector_model = partial(vector_model, scheduler=scheduler)
+    global_entities, global_relations = set(), set()
+    entity_ids, entity_tasks = {}, {}
+    completed = 0
+    chunk_queue, ent_queue = asyncio.Queue(max_queue_size), asyncio.Queue(max_queue_size)
+    rel_queue, rel_merge_queue = asyncio.Queue(max_queue_size), asyncio.Queue(max_queue_size)
+    summary_limit = asyncio.Semaphore(max_summaries)
+
+    async def get_embeddings(objs, priority=Scheduler.NORMAL):
+        await object_embeddings(objs, vector_model, priority=priority)
+
+    async def summarize(obj, summary_tokens=128):
+        if token_count(obj) > summary_tokens:
+            prompt = format_template(PROMPTS['SUMMARIZE_DESC'], name=obj['name'], desc=obj['desc'])
+            async with summary_limit:
+                desc = await chat_model(prompt, max_tokens=summary_tokens, priority=Scheduler.HIGH)
+            set_fragments(obj, [[None, desc, len(tokenizer.encode(desc))]])
+            logger.info(f'为{obj['name']}总结了摘要')
+
+    async def get_summaries(objs, summary_tokens=128):
+        await asyncio.gather(*[summarize(obj, summary_tokens) for obj in objs])
+        await get_embeddings(objs, priority=Scheduler.HIGH)
+
+    async def summarize_deferred(vdb, upsert_graph=None, batch_size=64):
+        ids = await vdb.find({'deferred': True})
+        for i in range(0, len(ids), batch_size):
+            objs = await vdb.get(ids[i:i + batch_size])
+            for obj in objs:
+                obj.pop('deferred', None)
+            await get_summaries(objs)
+            await vdb.upsert(list_to_dict(objs))
+            if upsert_graph is not None:
+                for obj in strip_fragments(objs):
+                    await upsert_graph(obj)
+        if ids:
+            logger.info(f'完成了{len(ids)}个对象的延迟摘要')
+
+    def add_fragments(objs, id):
+        for obj, tokens in zip(objs, tokenizer.encode_batch([obj['desc'] for obj in objs])):
+            set_fragments(obj, [[id, obj['desc'], len(tokens)]])
+
+    def absorb(obj, other, stored=False):
+        old, new = (other, obj) if stored else (obj, other)
+        seen, fragments = set(), []
+        for fragment in desc_fragments(old) + desc_fragments(new):
+            if fragment[1] not in seen:
+                seen.add(fragment[1])
+                fragments.append(fragment)
+        while len(fragments) > 2 and sum(i[2] + 1 for i in fragments) - 1 > max_desc_tokens:
+            fragments.pop(1)
+        set_fragments(obj, fragments)
+        obj['chunks'] = list(dict.fromkeys(old.get('chunks', []) + new.get('chunks', [])))
+
+    def adopt(obj, match):
+        obj['chunks'] = match['chunks']
+        set_fragments(obj, desc_fragments(match))
+
+    def replayed(obj, match):
+        return set(obj.get('chunks', [])) <= set(match.get('chunks', []))
+
+    def collapse(objs, keys=None):
+        groups = similarity_groups([obj['embedding'] for obj in objs], threshold, keys)
+        res = {}
+        for obj, group in zip(objs, groups):
+            if group not in res:
+                res[group] = obj
+            else:
+                logger.info(f'合并了重复的{obj['name']}')
+                absorb(res[group], obj)
+        return list(res.values()), [res[group] for group in groups]
 
     async def loop_extract(objs, prompt, type):
         history = create_message(prompt, objs)
@@ -78,33 +362,53 @@ async def entity_extraction(chunks, chat_model, vector_model, vdb_ent, vdb_rel,
         record = await chat_model(prompt, response_format={'type': 'json_object'})
         entities = json.loads(record)['entities']
         entities = await loop_extract(entities, prompt, 'entities') if max_rounds > 0 else entities
+        for ent in entities:
+            ent['chunks'] = [id]
+        add_fragments(entities, id)
 
         logger.info(f'完成{id}的实体提取')
         return entities
 
-    async def merge_entities(entities):
-        nonlocal global_entities
-        update_entities = []
+    async def merge_entities(batch):
+        update_entities = {}
         new_entities = []
 
-        await get_embeddings(entities)
-        for ent in entities:
-            match = await vdb_ent.query(ent['embedding'], top_k=1, threshold=threshold)
+        entities, owners = collapse([ent for _, chunk_entities in batch for ent in chunk_entities])
+        matches = await vdb_ent.query_batch([ent['embedding'] for ent in entities], top_k=1, threshold=threshold)
+        for ent, match in zip(entities, matches):
             match = match[0] if match else None
-            if match:
+            if match and match['id'] in update_entities:
+                logger.info(f'合并了{ent['name']}')
+                if not replayed(ent, match):
+                    absorb(update_entities[match['id']], ent)
+                ent['id'] = match['id']
+                ent['name'] = match['name']
+            elif match:
                 logger.info(f'合并了{ent['name']}')
                 ent['id'] = match['id']
                 ent['name'] = match['name']
-                ent['desc'] += '\n' + match['desc']
-                update_entities.append(ent)
+                if replayed(ent, match):
+                    adopt(ent, match)
+                else:
+                    absorb(ent, match, stored=True)
+                update_entities[ent['id']] = ent
             else:
                 logger.info(f'新增了{ent['name']}')
                 ent['id'] = md5(ent['desc'], prefix='ent')
                 new_entities.append(ent)
             global_entities.add(ent['id'])
 
-        ent_task = asyncio.create_task(upsert_task(vdb_ent, update_entities, new_entities))
-        return entities, ent_task
+        ent_task = asyncio.create_task(upsert_task(vdb_ent, list(update_entities.values()), new_entities,
+                                                   gdb_kg.upsert_node if gdb_kg is not None else None))
+
+        res, start = [], 0
+        for chunk, chunk_entities in batch:
+            chunk_owners = owners[start:start + len(chunk_entities)]
+            res.append((chunk, list({ent['id']: ent for ent in chunk_owners}.values())))
+            entity_ids[chunk[0]] = [ent['id'] for ent in res[-1][1]]
+            entity_tasks[chunk[0]] = ent_task
+            start += len(chunk_entities)
+        return res, ent_task
 
     async def extract_relations(chunk, entities):
         id, content = chunk[0], chunk[1]['content']
@@ -114,6 +418,9 @@ async def entity_extraction(chunks, chat_model, vector_model, vdb_ent, vdb_rel,
         record = await chat_model(prompt, response_format={'type': 'json_object'})
         relations = json.loads(record)['relations']
         relations = await loop_extract(relations, prompt, 'relations') if max_rounds > 0 else relations
+        for rel in relations:
+            rel['chunks'] = [id]
+        add_fragments(relations, id)
 
         name_to_id = {ent['name']: ent['id'] for ent in entities}
         for i in range(len(relations) - 1, -1, -1):
@@ -135,59 +442,155 @@ async def entity_extraction(chunks, chat_model, vector_model, vdb_ent, vdb_rel,
         logger.info(f'完成{id}的关系提取')
         return relations
 
-    async def merge_relations(relations):
-        nonlocal global_relations
-        update_relations = []
+    async def merge_relations(batch):
+        update_relations = {}
         new_relations = []
 
-        await get_embeddings(relations)
-        for rel in relations:
-            match = await vdb_rel.query(rel['embedding'], top_k=1, threshold=threshold)
+        relations = [rel for _, chunk_relations in batch for rel in chunk_relations]
+        relations, owners = collapse(relations, keys=[(rel['source'], rel['target']) for rel in relations])
+        matches = await vdb_rel.query_batch([rel['embedding'] for rel in relations], top_k=1, threshold=threshold)
+        for rel, match in zip(relations, matches):
             match = match[0] if match else None
-            if match:
+            if match and match['id'] in update_relations:
+                logger.info(f'合并了{rel['name']}')
+                if not replayed(rel, match):
+                    absorb(update_relations[match['id']], rel)
+                rel['id'] = match['id']
+            elif match:
                 logger.info(f'合并了{rel['name']}')
                 rel['source'] = match['source']
                 rel['target'] = match['target']
                 rel['id'] = match['id']
                 rel['name'] = match['name']
-                rel['desc'] += '\n' + match['desc']
-                update_relations.append(rel)
+                if replayed(rel, match):
+                    adopt(rel, match)
+                else:
+                    absorb(rel, match, stored=True)
+                update_relations[rel['id']] = rel
             else:
                 logger.info(f'新增了{rel['name']}')
                 rel['id'] = md5(rel['desc'], prefix='rel')
                 new_relations.append(rel)
             global_relations.add(rel['id'])
 
-        rel_task = asyncio.create_task(upsert_task(vdb_rel, update_relations, new_relations))
-        return rel_task
-
-    async def upsert_task(vdb, update_objs, new_objs):
-        if update_objs:
+        rel_task = asyncio.create_task(upsert_task(vdb_rel, list(update_relations.values()), new_relations,
+                                                   gdb_kg.upsert_edge if gdb_kg is not None else None))
+
+        res, start = [], 0
+        for chunk, chunk_relations in batch:
+            chunk_owners = owners[start:start + len(chunk_relations)]
+            res.append((chunk, list(dict.fromkeys(rel['id'] for rel in chunk_owners))))
+            start += len(chunk_relations)
+        return res, rel_task
+
+    async def upsert_task(vdb, update_objs, new_objs, upsert_graph=None):
+        if not update_objs and not new_objs:
+            return
+        if update_objs and defer_summaries:
+            stored = {obj['id']: obj['embedding'] for obj in await vdb.get([obj['id'] for obj in update_objs])}
+            for obj in update_objs:
+                obj['deferred'] = True
+                obj['embedding'] = stored.get(obj['id'], obj['embedding'])
+        elif update_objs:
             await get_summaries(update_objs)
-        objs = list_to_dict(update_objs + new_objs)
-        await vdb.upsert(objs)
-
-    async def process_chunk(chunk):
-        nonlocal last_ent_task, last_rel_task
-
-        logger.info(f'正在处理{chunk[0]}的实体提取')
-        entities = await extract_entities(chunk)
-        async with lock1:
-            if last_ent_task:
-                await last_ent_task
-            entities, last_ent_task = await merge_entities(entities)
-
-        logger.info(f'正在处理{chunk[0]}的关系提取')
-        relations = await extract_relations(chunk, entities)
-        async with lock2:
-            if last_rel_task:
-                await last_rel_task
-            last_rel_task = await merge_relations(relations)
+        await vdb.upsert(list_to_dict(update_objs + new_objs))
+        if upsert_graph is not None:
+            for obj in strip_fragments(update_objs + new_objs):
+                await upsert_graph(obj)
+
+    async def checkpoint():
+        storages = [vdb_ent, vdb_rel, gdb_kg, kv_chunks]
+        await asyncio.gather(*[storage.save() for storage in storages if storage is not None])
+        logger.info(f'保存了检查点')
+
+    async def feed():
+        seen = set()
+
+        async def put(chunk):
+            if chunk[0] in seen:
+                return
+            seen.add(chunk[0])
+            await chunk_queue.put(chunk)
+
+        if hasattr(chunks, '__aiter__'):
+            async for chunk in chunks:
+                await put(chunk)
+        else:
+            for chunk in chunks:
+                await put(chunk)
+        for _ in range(max_workers):
+            await chunk_queue.put(None)
+
+    async def entity_worker():
+        while (chunk := await chunk_queue.get()) is not None:
+            logger.info(f'正在处理{chunk[0]}的实体提取')
+            entities = await extract_entities(chunk)
+            await get_embeddings(entities)
+            await ent_queue.put((chunk, entities))
+
+    async def relation_worker():
+        while (item := await rel_queue.get()) is not None:
+            chunk, entities = item
+            logger.info(f'正在处理{chunk[0]}的关系提取')
+            relations = await extract_relations(chunk, entities)
+            await get_embeddings(relations)
+            await rel_merge_queue.put((chunk, relations))
+
+    async def mark_done(res):
+        nonlocal completed
+        await asyncio.gather(*{entity_tasks.pop(chunk[0]) for chunk, _ in res})
+        if kv_chunks is not None:
+            await kv_chunks.upsert({chunk[0]: {'doc': chunk[1].get('doc'), 'status': 'done',
+                                               'entities': entity_ids.pop(chunk[0], []),
+                                               'relations': relation_ids} for chunk, relation_ids in res})
+
+        completed += len(res)
+        if checkpoint_interval and completed >= checkpoint_interval:
+            completed = 0
+            await checkpoint()
+
+    async def merge_worker(queue, merge, output=None, on_done=None):
+        last_task, last_res, done = AwaitNone, [], False
+        while not done:
+            batch = [await queue.get()]
+            while len(batch) < merge_batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            done = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
 
-    await asyncio.gather(*[process_chunk(chunk) for chunk in chunks])
+            await last_task
+            if on_done is not None:
+                await on_done(last_res)
+            last_res, last_task = await merge(batch)
+            if output is not None:
+                for item in last_res:
+                    await output.put(item)
+        await last_task
+        if on_done is not None:
+            await on_done(last_res)
+        if output is not None:
+            for _ in range(max_workers):
+                await output.put(None)
+
+    async def stage(worker, output):
+        await asyncio.gather(*[worker() for _ in range(max_workers)])
+        await output.put(None)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(feed())
+        tg.create_task(stage(entity_worker, ent_queue))
+        tg.create_task(merge_worker(ent_queue, merge_entities, rel_queue))
+        tg.create_task(stage(relation_worker, rel_merge_queue))
+        tg.create_task(merge_worker(rel_merge_queue, merge_relations, on_done=mark_done))
+    await asyncio.gather(summarize_deferred(vdb_ent, gdb_kg.upsert_node if gdb_kg is not None else None),
+                         summarize_deferred(vdb_rel, gdb_kg.upsert_edge if gdb_kg is not None else None))
+    if checkpoint_interval:
+        await checkpoint()
 
     entities, relations = await asyncio.gather(vdb_ent.get(list(global_entities)), vdb_rel.get(list(global_relations)))
-    return entities, relations
+    return strip_fragments(entities), strip_fragments(relations)
 
 
 async def graph_construction(entities, relations, gdb_kg):
@@ -202,8 +605,8 @@ async def graph_construction(entities, relations, gdb_kg):
 
 async def path_retrieval(query, vector_model, vdb_ent, vdb_rel, gdb_kg,
                          top_k=5, base_threshold=0.5, sim_threshold=0.7,
-                         beam_width=5, max_depth=5, max_paths=3):
-    query = await vector_model(query)
+                         beam_width=5, max_depth=5, max_paths=3, scheduler=None):
+    query = await vector_model(query, scheduler=scheduler or get_scheduler(), priority=Scheduler.HIGH)
     query = query[0]
     entities, relations = await asyncio.gather(vdb_ent.query(query, top_k, base_threshold),
                                                vdb_rel.query(query, top_k, base_threshold))
@@ -226,92 +629,100 @@ async def path_retrieval(query, vector_model, vdb_ent, vdb_rel, gdb_kg,
     seed = seed_high if seed_high else seed_low
     seed = [await gdb_kg.get_node(id) for id in seed]
 
-    def path_score(path):
-        sim_avg = 0.0
-        for obj in path:
-            sim = cosine_similarity(np.array(obj['embedding']), query)
-            sim_avg += sim
-        sim_avg /= len(path)
+    def similarity(matrix):
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        return np.where(norms == 0, 0.0, matrix @ query / np.where(norms == 0, 1, norms))
+
+    def seed_weight(ids):
+        return np.array([0.1 if id in seed_high else 0.05 if id in seed_low else 0.0 for id in ids])
 
+    def path_score(sim_sum, length, seed_bonus):
         length_penalty = 1.0
-        if len(path) < 5:
-            length_penalty -= 0.03 * (7 - len(path))
-        elif len(path) > 7:
-            length_penalty -= 0.05 * (len(path) - 7)
+        if length < 5:
+            length_penalty -= 0.03 * (7 - length)
+        elif length > 7:
+            length_penalty -= 0.05 * (length - 7)
 
-        seed_bonus = 1.0
-        for i, obj in enumerate(path):
-            if i % 2 == 0:
-                if obj['id'] in seed_high:
-                    seed_bonus += 0.1
-                elif obj['id'] in seed_low:
-                    seed_bonus += 0.05
+        return sim_sum / length * length_penalty * seed_bonus
 
-        return sim_avg * length_penalty * seed_bonus
+    def top(scores, k):
+        k = min(k, len(scores))
+        index = np.argpartition(-scores, k - 1)[:k]
+        return index[np.lexsort((index, -scores[index]))]
 
     async def beam_search():
-        beams = []
-        for s in seed:
-            path = [s]
-            score = path_score(path)
-            beams.append((path, score))
-        beams.sort(key=lambda x: x[1], reverse=True)
-        beams = beams[:beam_width]
+        ids = [s['id'] for s in seed]
+        sim_sums = similarity(np.stack([np.asarray(s['embedding'], dtype=np.float32).flatten() for s in seed]))
+        seed_bonuses = 1.0 + seed_weight(ids)
+        scores = path_score(sim_sums, 1, seed_bonuses)
+        index = top(scores, beam_width)
+        beams = [[ids[i]] for i in index]
+        scores, sim_sums, seed_bonuses = scores[index], sim_sums[index], seed_bonuses[index]
 
         paths = []
         for depth in range(max_depth):
-            next_beams = []
-            for path, score in beams:
-                last = path[-1]
-
-                neighbors = []
-                for u, v, e in await gdb_kg.out_edges(last['id']):
-                    if v not in [node['id'] for node in path[::2]]:
-                        v = await gdb_kg.get_node(v)
-                        neighbors.append((e, v))
-
-                for u, v, e in await gdb_kg.in_edges(last['id']):
-                    if u not in [node['id'] for node in path[::2]]:
-                        u = await gdb_kg.get_node(u)
-                        neighbors.append((e, u))
-
-                for e, v in neighbors:
-                    new_path = path + [e, v]
-                    new_score = path_score(new_path)
-                    next_beams.append((new_path, new_score))
-
-                paths.append((path, score))
-
-            if not next_beams:
+            frontier = list(dict.fromkeys(path[-1] for path in beams))
+            sources, edges, nodes, edge_embeddings, node_embeddings = await gdb_kg.expand(frontier, hops=max_depth - depth)
+            offsets = np.searchsorted(sources, np.arange(len(frontier) + 1))
+
+            beam_index, entries = [], []
+            for i, path in enumerate(beams):
+                f = frontier.index(path[-1])
+                visited = set(path[::2])
+                keep = [j for j in range(offsets[f], offsets[f + 1]) if nodes[j] not in visited]
+                beam_index.extend([i] * len(keep))
+                entries.extend(keep)
+                paths.append((path, scores[i]))
+
+            if not entries:
                 break
 
-            next_beams.sort(key=lambda x: x[1], reverse=True)
-            beams = next_beams[:beam_width]
+            beam_index, entries = np.array(beam_index), np.array(entries)
+            edge_sims, node_sims = similarity(edge_embeddings[entries]), similarity(node_embeddings[entries])
+            next_sims = sim_sums[beam_index] + edge_sims + node_sims
+            next_bonuses = seed_bonuses[beam_index] + seed_weight(nodes[entries])
+            next_scores = path_score(next_sims, len(beams[0]) + 2, next_bonuses)
 
-        paths.extend(beams)
+            index = top(next_scores, beam_width)
+            beams = [beams[beam_index[i]] + [edges[entries[i]], nodes[entries[i]]] for i in index]
+            scores, sim_sums, seed_bonuses = next_scores[index], next_sims[index], next_bonuses[index]
+
+        paths.extend(zip(beams, scores))
         paths.sort(key=lambda x: x[1], reverse=True)
-        return paths[:max_paths]
+        paths = paths[:max_paths]
+
+        objs = {s['id']: s for s in seed}
+        for path, _ in paths:
+            for i, id in enumerate(path):
+                if id not in objs:
+                    objs[id] = await gdb_kg.get_node(id) if i % 2 == 0 else await gdb_kg.get_edge(id)
+        return [([objs[id] for id in path], float(score)) for path, score in paths]
 
     paths = await beam_search()
 
     return paths
 
 
-async def answer_generation(query, paths, chat_model, gdb_kg):
-    entities, relations = {}, {}
+async def answer_generation(query, paths, chat_model, gdb_kg, max_tokens=None, scheduler=None):
+    entities, relations, used = {}, {}, 0
     for path in paths:
         for i, obj in enumerate(path):
+            if obj['id'] in entities or obj['id'] in relations:
+                continue
+            tokens = obj.get('tokens') or len(tokenizer.encode(obj['desc']))
+            if max_tokens is not None and used + tokens > max_tokens:
+                continue
+            used += tokens
+
             if i % 2 == 0:
-                if obj['id'] not in entities:
-                    entities[obj['id']] = {'name': obj['name'], 'desc': obj['desc']}
+                entities[obj['id']] = {'name': obj['name'], 'desc': obj['desc']}
             else:
-                if obj['id'] not in relations:
-                    source = await gdb_kg.get_node(obj['source'])
-                    target = await gdb_kg.get_node(obj['target'])
-                    relations[obj['id']] = {'source': source['name'], 'target': target['name'],
-                                            'name': obj['name'], 'desc': obj['desc']}
+                source = await gdb_kg.get_node(obj['source'])
+                target = await gdb_kg.get_node(obj['target'])
+                relations[obj['id']] = {'source': source['name'], 'target': target['name'],
+                                        'name': obj['name'], 'desc': obj['desc']}
     entities, relations = list(entities.values()), list(relations.values())
 
     prompt = format_template(PROMPTS['KG_QUERY'], query=query, entities=entities, relations=relations)
-    answer = await chat_model(prompt)
+    answer = await chat_model(prompt, scheduler=scheduler or get_scheduler(), priority=Scheduler.HIGH)
     return answer
\ No newline at end of file
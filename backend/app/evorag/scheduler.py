@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+from utils import tokenizer
+
+
+class Scheduler:
+    HIGH, NORMAL = 0, 1
+
+    def __init__(self, max_concurrency=16, tokens_per_minute=None):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self.running = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.timer = None
+
+    def cost(self, texts, max_tokens=None):
+        if self.tokens_per_minute is None:
+            return 0
+        texts = [texts] if isinstance(texts, str) else texts
+        return sum(len(i) for i in tokenizer.encode_batch([str(i) for i in texts])) + (max_tokens or 0)
+
+    def refill(self):
+        if self.tokens_per_minute is None:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.tokens_per_minute,
+                          self.tokens + (now - self.updated) * self.tokens_per_minute / 60)
+        self.updated = now
+
+    def wake(self):
+        self.timer = None
+        self.refill()
+        while self.waiters and self.running < self.max_concurrency:
+            priority, _, cost, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+
+            if self.tokens_per_minute is not None:
+                need = min(cost, self.tokens_per_minute)
+                if self.tokens < need:
+                    delay = (need - self.tokens) * 60 / self.tokens_per_minute
+                    self.timer = asyncio.get_running_loop().call_later(delay, self.wake)
+                    break
+                self.tokens -= cost
+
+            heapq.heappop(self.waiters)
+            self.running += 1
+            future.set_result(None)
+
+    async def acquire(self, cost=0, priority=NORMAL):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), cost, future))
+        if self.timer is None:
+            self.wake()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.running -= 1
+        if self.timer is None:
+            self.wake()
+
+    @asynccontextmanager
+    async def limit(self, cost=0, priority=NORMAL):
+        await self.acquire(cost, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+shared_scheduler = None
+
+
+def get_scheduler():
+    global shared_scheduler
+    loop = asyncio.get_running_loop()
+    if shared_scheduler is None or shared_scheduler[0] is not loop:
+        tokens_per_minute = os.environ.get('LLM_TOKENS_PER_MINUTE')
+        scheduler = Scheduler(max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', 16)),
+                              tokens_per_minute=int(tokens_per_minute) if tokens_per_minute else None)
+        shared_scheduler = (loop, scheduler)
+    return shared_scheduler[1]
+
+
+if __name__ == '__main__':
+    scheduler = Scheduler(max_concurrency=2, tokens_per_minute=600)
+
+    async def task(i, priority):
+        async with scheduler.limit(scheduler.cost(f'task {i}', max_tokens=20), priority):
+            print(f'{time.monotonic():.2f} task {i} priority {priority}')
+            await asyncio.sleep(0.1)
+
+    async def main():
+        await asyncio.gather(*[task(i, Scheduler.HIGH if i % 3 == 0 else Scheduler.NORMAL) for i in range(10)])
+
+    asyncio.run(main())
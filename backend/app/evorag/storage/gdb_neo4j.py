@@ -0,0 +1,342 @@
+import time
+
+import numpy as np
+
+from base import BaseGraphStorage
+
+
+class Neo4jStorage(BaseGraphStorage):
+    QUERIES = {
+        'constraint': 'CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE n.id IS UNIQUE',
+        'index': 'CREATE INDEX IF NOT EXISTS FOR ()-[r:RELATED]-() ON (r.id)',
+        'upsert_nodes': 'UNWIND $rows AS row '
+                        'MERGE (n:{label} {id: row.id}) SET n += row',
+        'upsert_edges': 'UNWIND $rows AS row '
+                        'MERGE (u:{label} {id: row.source}) '
+                        'MERGE (v:{label} {id: row.target}) '
+                        'MERGE (u)-[r:RELATED {id: row.id}]->(v) SET r += row',
+        'has_node': 'MATCH (n:{label} {id: $id}) RETURN n.id',
+        'has_edge': 'MATCH (:{label})-[r:RELATED {id: $id}]->() RETURN r.id',
+        'get_node': 'MATCH (n:{label} {id: $id}) RETURN n',
+        'get_edge': 'MATCH (:{label})-[r:RELATED {id: $id}]->() RETURN r',
+        'in_edges': 'MATCH (u:{label})-[r:RELATED]->(v:{label} {id: $id}) RETURN u.id AS u, v.id AS v, r',
+        'out_edges': 'MATCH (u:{label} {id: $id})-[r:RELATED]->(v:{label}) RETURN u.id AS u, v.id AS v, r',
+        'delete_node': 'MATCH (n:{label} {id: $id}) DETACH DELETE n',
+        'delete_edge': 'MATCH (:{label})-[r:RELATED {id: $id}]->() DELETE r',
+        'node_degree': 'MATCH (n:{label} {id: $id}) RETURN COUNT { (n)-[:RELATED]-() } AS degree',
+        'expand': 'MATCH (s:{label}) WHERE s.id IN $ids '
+                  'MATCH (s)-[:RELATED*0..{depth}]-(u:{label}) '
+                  'WITH DISTINCT u '
+                  'OPTIONAL MATCH (u)-[r:RELATED]-(v:{label}) '
+                  'RETURN u.id AS source, r.id AS edge, v.id AS node, '
+                  'r.embedding AS edge_embedding, v.embedding AS node_embedding, '
+                  'startNode(r) = u AS outgoing '
+                  'ORDER BY source, outgoing DESC',
+    }
+
+    def __init__(self, namespace, config):
+        super().__init__(namespace, config)
+        self.uri = self.config.get('neo4j_uri')
+        self.auth = (self.config.get('neo4j_user'), self.config.get('neo4j_password'))
+        self.database = self.config.get('neo4j_database')
+        self.pool_size = self.config.get('neo4j_pool_size', 64)
+        self.batch_size = self.config.get('neo4j_batch_size', 1000)
+        self.cache_ttl = self.config.get('neo4j_cache_ttl', 10)
+        self.cache_size = self.config.get('neo4j_cache_size', 100000)
+        self.label = f'`{self.namespace}`'
+
+        self.driver = self.config.get('neo4j_driver')
+        self.ready = False
+        self.pending_nodes, self.pending_edges = {}, {}
+        self.neighborhood = {}
+
+    def statement(self, name, **kwargs):
+        query = self.QUERIES[name].replace('{label}', self.label)
+        for k, v in kwargs.items():
+            query = query.replace(f'{{{k}}}', str(v))
+        return query
+
+    async def get_driver(self):
+        if self.driver is None:
+            from neo4j import AsyncGraphDatabase
+
+            if self.uri is None or None in self.auth:
+                from app.core.config import settings
+
+                self.uri = self.uri or settings.NEO4J_URI
+                self.auth = (self.auth[0] or settings.NEO4J_USER, self.auth[1] or settings.NEO4J_PASSWORD)
+            self.driver = AsyncGraphDatabase.driver(self.uri, auth=self.auth,
+                                                    max_connection_pool_size=self.pool_size)
+        if not self.ready:
+            self.ready = True
+            await self.run(self.statement('constraint'))
+            await self.run(self.statement('index'))
+        return self.driver
+
+    async def run(self, query, **params):
+        async with self.driver.session(database=self.database) as session:
+            result = await session.run(query, **params)
+            return [record async for record in result]
+
+    async def query(self, name, **params):
+        await self.get_driver()
+        await self.flush()
+        return await self.run(self.statement(name), **params)
+
+    @staticmethod
+    def pack(attrs):
+        attrs = attrs.copy()
+        if 'embedding' in attrs:
+            attrs['embedding'] = np.asarray(attrs['embedding'], dtype=np.float32).flatten().tolist()
+        return {k: v.item() if isinstance(v, np.generic) else v for k, v in attrs.items()}
+
+    @staticmethod
+    def unpack(attrs):
+        attrs = dict(attrs)
+        if attrs.get('embedding') is not None:
+            attrs['embedding'] = np.asarray(attrs['embedding'], dtype=np.float32)
+        return attrs
+
+    async def flush(self):
+        await self.get_driver()
+        nodes, self.pending_nodes = list(self.pending_nodes.values()), {}
+        edges, self.pending_edges = list(self.pending_edges.values()), {}
+        for i in range(0, len(nodes), self.batch_size):
+            await self.run(self.statement('upsert_nodes'), rows=nodes[i:i + self.batch_size])
+        for i in range(0, len(edges), self.batch_size):
+            await self.run(self.statement('upsert_edges'), rows=edges[i:i + self.batch_size])
+
+    async def has_node(self, v):
+        return bool(await self.query('has_node', id=v))
+
+    async def has_edge(self, e):
+        k = e[2] if isinstance(e, tuple) else e
+        return bool(await self.query('has_edge', id=k))
+
+    async def get_node(self, v):
+        res = await self.query('get_node', id=v)
+        return self.unpack(res[0]['n']) if res else None
+
+    async def get_edge(self, e):
+        k = e[2] if isinstance(e, tuple) else e
+        res = await self.query('get_edge', id=k)
+        return self.unpack(res[0]['r']) if res else None
+
+    async def in_edges(self, v):
+        res = await self.query('in_edges', id=v)
+        return [(i['u'], i['v'], self.unpack(i['r'])) for i in res]
+
+    async def out_edges(self, v):
+        res = await self.query('out_edges', id=v)
+        return [(i['u'], i['v'], self.unpack(i['r'])) for i in res]
+
+    async def upsert_node(self, v):
+        self.neighborhood = {}
+        self.pending_nodes[v['id']] = {**self.pending_nodes.get(v['id'], {}), **self.pack(v)}
+        if len(self.pending_nodes) >= self.batch_size:
+            await self.flush()
+
+    async def upsert_edge(self, e):
+        self.neighborhood = {}
+        self.pending_edges[e['id']] = {**self.pending_edges.get(e['id'], {}), **self.pack(e)}
+        if len(self.pending_edges) >= self.batch_size:
+            await self.flush()
+
+    async def delete_node(self, v):
+        self.neighborhood = {}
+        await self.query('delete_node', id=v)
+
+    async def delete_edge(self, e):
+        self.neighborhood = {}
+        k = e[2] if isinstance(e, tuple) else e
+        await self.query('delete_edge', id=k)
+
+    async def neighbors(self, v):
+        sources, edges, nodes, _, _ = await self.expand([v])
+        return list(zip(edges, nodes))
+
+    async def fetch(self, ids, hops):
+        await self.get_driver()
+        await self.flush()
+        res = await self.run(self.statement('expand', depth=max(hops - 1, 0)), ids=list(ids))
+
+        neighborhood = {id: [] for id in ids}
+        for i in res:
+            rows = neighborhood.setdefault(i['source'], [])
+            if i['edge'] is not None:
+                rows.append((i['edge'], i['node'], i['edge_embedding'], i['node_embedding']))
+
+        now = time.monotonic()
+        if len(self.neighborhood) + len(neighborhood) > self.cache_size:
+            self.neighborhood = {}
+        for id in list(neighborhood)[:self.cache_size]:
+            self.neighborhood[id] = (now, neighborhood[id])
+        return neighborhood
+
+    async def expand(self, ids, hops=1):
+        now = time.monotonic()
+        missing = [id for id in dict.fromkeys(ids)
+                   if id not in self.neighborhood or now - self.neighborhood[id][0] > self.cache_ttl]
+        fetched = await self.fetch(missing, hops) if missing else {}
+
+        rows = [(i, row) for i, id in enumerate(ids)
+                for row in (fetched[id] if id in fetched else self.neighborhood[id][1])]
+
+        def matrix(index):
+            dim = next((len(row[index]) for _, row in rows if row[index] is not None), 0)
+            return np.array([row[index] if row[index] is not None else [0.0] * dim for _, row in rows],
+                            dtype=np.float32).reshape(len(rows), dim)
+
+        return (np.array([i for i, _ in rows], dtype=np.int64),
+                np.array([row[0] for _, row in rows], dtype=object),
+                np.array([row[1] for _, row in rows], dtype=object),
+                matrix(2), matrix(3))
+
+    async def node_degree(self, v):
+        res = await self.query('node_degree', id=v)
+        return res[0]['degree'] if res else 0
+
+    async def edge_degree(self, u, v, k):
+        return await self.node_degree(u) + await self.node_degree(v)
+
+    async def save(self):
+        await self.flush()
+
+    async def close(self):
+        if self.driver is not None:
+            await self.flush()
+            await self.driver.close()
+            self.driver = None
+            self.ready = False
+
+
+if __name__ == '__main__':
+    import asyncio
+
+    class FakeResult:
+        def __init__(self, records):
+            self.records = records
+
+        async def __aiter__(self):
+            for record in self.records:
+                yield record
+
+    class FakeDriver:
+        def __init__(self, storage):
+            self.nodes, self.edges, self.calls = {}, {}, []
+            self.handlers = {storage.statement(name): getattr(self, name)
+                             for name in storage.QUERIES if name != 'expand'}
+            self.handlers.update({storage.statement('expand', depth=depth): self.expand for depth in range(16)})
+
+        def session(self, database=None):
+            return self
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def run(self, query, **params):
+            self.calls.append(query.split()[0])
+            return FakeResult(self.handlers[query](query=query, **params))
+
+        async def close(self):
+            pass
+
+        def constraint(self, **params):
+            return []
+
+        index = constraint
+
+        def upsert_nodes(self, rows, **params):
+            for row in rows:
+                self.nodes.setdefault(row['id'], {}).update(row)
+            return []
+
+        def upsert_edges(self, rows, **params):
+            for row in rows:
+                for v in [row['source'], row['target']]:
+                    self.nodes.setdefault(v, {'id': v})
+                self.edges.setdefault(row['id'], {}).update(row)
+            return []
+
+        def has_node(self, id, **params):
+            return [{'n.id': id}] if id in self.nodes else []
+
+        def has_edge(self, id, **params):
+            return [{'r.id': id}] if id in self.edges else []
+
+        def get_node(self, id, **params):
+            return [{'n': self.nodes[id]}] if id in self.nodes else []
+
+        def get_edge(self, id, **params):
+            return [{'r': self.edges[id]}] if id in self.edges else []
+
+        def in_edges(self, id, **params):
+            return [{'u': r['source'], 'v': r['target'], 'r': r} for r in self.edges.values() if r['target'] == id]
+
+        def out_edges(self, id, **params):
+            return [{'u': r['source'], 'v': r['target'], 'r': r} for r in self.edges.values() if r['source'] == id]
+
+        def delete_node(self, id, **params):
+            self.nodes.pop(id, None)
+            self.edges = {k: r for k, r in self.edges.items() if id not in (r['source'], r['target'])}
+            return []
+
+        def delete_edge(self, id, **params):
+            self.edges.pop(id, None)
+            return []
+
+        def node_degree(self, id, **params):
+            return [{'degree': sum((r['source'] == id) + (r['target'] == id) for r in self.edges.values())}] \
+                if id in self.nodes else []
+
+        def incident(self, u):
+            return [(r, r['target'] if r['source'] == u else r['source'], r['source'] == u)
+                    for r in self.edges.values() if u in (r['source'], r['target'])]
+
+        def expand(self, ids, query, **params):
+            depth = int(query.split('*0..')[1].split(']')[0])
+            frontier = [id for id in ids if id in self.nodes]
+            reached = set(frontier)
+            for _ in range(depth):
+                frontier = [v for u in frontier for _, v, _ in self.incident(u) if v not in reached]
+                reached.update(frontier)
+
+            res = []
+            for u in sorted(reached):
+                edges = sorted(self.incident(u), key=lambda x: not x[2])
+                res.extend({'source': u, 'edge': r['id'], 'node': v, 'edge_embedding': r.get('embedding'),
+                            'node_embedding': self.nodes[v].get('embedding'), 'outgoing': out}
+                           for r, v, out in edges)
+                if not edges:
+                    res.append({'source': u, 'edge': None, 'node': None, 'edge_embedding': None,
+                                'node_embedding': None, 'outgoing': None})
+            return res
+
+    async def main():
+        gdb = Neo4jStorage('test', {'neo4j_batch_size': 2})
+        gdb.driver = driver = FakeDriver(gdb)
+        for i in range(5):
+            await gdb.upsert_node({'id': f'test-{i}', 'name': f'node {i}', 'embedding': [i, i, i]})
+        for i in range(4):
+            await gdb.upsert_edge({'source': f'test-{i}', 'target': f'test-{i + 1}',
+                                   'id': f'edge-{i}', 'name': f'edge {i}', 'embedding': [i, 0, 0]})
+        await gdb.flush()
+        print(len(driver.nodes), len(driver.edges), driver.calls.count('UNWIND'))
+
+        print(await gdb.get_node('test-1'))
+        print(await gdb.get_edge('edge-1'))
+        sources, edges, nodes, edge_embeddings, node_embeddings = await gdb.expand(['test-0'], hops=3)
+        print(sources, edges, nodes, node_embeddings.shape)
+        calls = len(driver.calls)
+        print(await gdb.expand(['test-1', 'test-2']))
+        print('cached', len(driver.calls) == calls)
+
+        await gdb.delete_edge('edge-1')
+        await gdb.delete_node('test-4')
+        print(await gdb.neighbors('test-1'), await gdb.neighbors('test-3'), await gdb.node_degree('test-2'))
+        await gdb.close()
+
+    asyncio.run(main())
@@ -1,18 +1,172 @@
+import asyncio
 import os
+import shutil
 
 import networkx as nx
+import numpy as np
 
 from base import BaseGraphStorage
-from utils import list_to_str, str_to_list
+from utils import list_to_str, str_to_list, read_json, write_json
+from utils import to_columns, from_columns, find_dir, replace_dir, uuid4
+from wal import WriteAheadLog, encode_vector, decode_vector
+
+
+class Adjacency:
+    def __init__(self, graph):
+        nodes = list(graph.nodes(data='row', default=-1))
+        self.ids = np.array([v for v, _ in nodes], dtype=object)
+        self.index = {id: i for i, id in enumerate(self.ids)}
+        self.node_rows = np.array([row for _, row in nodes], dtype=np.int64)
+
+        edges = [(u, v, k, e.get('row', -1)) for u, adj in graph._adj.items()
+                 for v, keys in adj.items() for k, e in keys.items()]
+        self.edge_ids = np.array([k for _, _, k, _ in edges], dtype=object)
+        self.edge_rows = np.array([row for _, _, _, row in edges], dtype=np.int64)
+        sources = np.fromiter((self.index[u] for u, _, _, _ in edges), dtype=np.int64, count=len(edges))
+        targets = np.fromiter((self.index[v] for _, v, _, _ in edges), dtype=np.int64, count=len(edges))
+        self.out_indptr, self.out_nodes, self.out_edges = self.csr(sources, targets, len(self.ids))
+        self.in_indptr, self.in_nodes, self.in_edges = self.csr(targets, sources, len(self.ids))
+
+    @staticmethod
+    def csr(sources, targets, size):
+        order = np.argsort(sources, kind='stable')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=size))]).astype(np.int64)
+        return indptr, targets[order], order
+
+    def neighbors(self, i):
+        out, into = slice(self.out_indptr[i], self.out_indptr[i + 1]), slice(self.in_indptr[i], self.in_indptr[i + 1])
+        return np.concatenate([self.out_edges[out], self.in_edges[into]]), \
+            np.concatenate([self.out_nodes[out], self.in_nodes[into]])
+
+    def expand(self, index):
+        parts = []
+        for indptr, nodes, edges in [(self.out_indptr, self.out_nodes, self.out_edges),
+                                     (self.in_indptr, self.in_nodes, self.in_edges)]:
+            counts = np.where(index >= 0, indptr[index + 1] - indptr[index], 0)
+            starts = np.repeat(indptr[index] - np.cumsum(counts) + counts, counts)
+            positions = starts + np.arange(counts.sum())
+            parts.append((np.repeat(np.arange(len(index)), counts), edges[positions], nodes[positions]))
+
+        sources, edges, nodes = [np.concatenate(i) for i in zip(*parts)]
+        order = np.argsort(sources, kind='stable')
+        return sources[order], edges[order], nodes[order]
 
 
 class NetworkXStorage(BaseGraphStorage):
     def __init__(self, namespace, config):
         super().__init__(namespace, config)
-        self.file_path = os.path.join(self.config.get('work_dir'), f'{self.namespace}.graphml')
-        self.graph = self.read_graphml(self.file_path) or nx.MultiDiGraph()
+        self.work_dir = self.config.get('work_dir')
+        self.file_path = os.path.join(self.work_dir, f'{self.namespace}.graphml')
+        self.matrix_path = os.path.join(self.work_dir, f'{self.namespace}.npy')
+        self.dir_path = os.path.join(self.work_dir, self.namespace)
+        self.format = self.config.get('graph_format', 'binary')
+
+        self.graph, self.embeddings = self.read_binary(self.dir_path, self.config.get('mmap'))
+        if self.graph is None:
+            self.graph = self.read_graphml(self.file_path) or nx.MultiDiGraph()
+            matrix = self.graph.graph.pop('matrix', None)
+            self.embeddings = self.read_matrix(os.path.join(self.work_dir, matrix) if matrix else self.matrix_path,
+                                               self.config.get('mmap'))
         self.ids = {e['id']: (u, v, e['id']) for u, v, e in self.graph.edges(data=True)}
+        self.size = 0 if self.embeddings is None else len(self.embeddings)
+        for attrs in [v for _, v in self.graph.nodes(data=True)] + [e for _, _, e in self.graph.edges(data=True)]:
+            if isinstance(attrs.get('embedding'), str):
+                attrs['row'] = self.write_row(str_to_list(attrs.pop('embedding')))
 
+        self.adjacency = None
+        self.wal = None
+        if self.config.get('wal'):
+            self.wal = WriteAheadLog(os.path.join(self.work_dir, f'{self.namespace}.wal'),
+                                     self.config.get('wal_compact_size', 64 << 20))
+            ops = {'upsert_node': self.put_node, 'upsert_edge': self.put_edge,
+                   'delete_node': self.remove_node, 'delete_edge': self.remove_edge}
+            for op, data in self.wal.replay():
+                if isinstance(data, dict) and 'embedding' in data:
+                    data['embedding'] = decode_vector(data['embedding'])
+                ops[op](tuple(data) if isinstance(data, list) else data)
+
+    @staticmethod
+    def read_binary(dir_path, mmap=False):
+        path = find_dir(dir_path, 'nodes.json')
+        if path is None:
+            return None, None
+
+        nodes, edges = read_json(os.path.join(path, 'nodes.json')), read_json(os.path.join(path, 'edges.json'))
+        indptr, indices = np.load(os.path.join(path, 'indptr.npy')), np.load(os.path.join(path, 'indices.npy'))
+        sources = np.repeat(np.arange(len(nodes['ids'])), np.diff(indptr))
+
+        graph, ids = nx.MultiDiGraph(), nodes['ids']
+        graph.add_nodes_from(zip(ids, from_columns(nodes)))
+        graph.add_edges_from((ids[u], ids[v], k, e)
+                             for u, v, k, e in zip(sources, indices, edges['keys'], from_columns(edges)))
+        embeddings = NetworkXStorage.read_matrix(os.path.join(path, 'embeddings.npy'), mmap)
+        return graph, embeddings
+
+    @staticmethod
+    def write_binary(graph, embeddings, dir_path):
+        ids = list(graph.nodes)
+        index = {id: i for i, id in enumerate(ids)}
+        edges = sorted(graph.edges(keys=True, data=True), key=lambda x: index[x[0]])
+        counts = np.bincount([index[u] for u, _, _, _ in edges], minlength=len(ids))
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        indices = np.array([index[v] for _, v, _, _ in edges], dtype=np.int32)
+
+        tmp_path = dir_path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        write_json({'ids': ids, **to_columns([v for _, v in graph.nodes(data=True)])},
+                   os.path.join(tmp_path, 'nodes.json'), indent=None)
+        write_json({'keys': [k for _, _, k, _ in edges], **to_columns([e for _, _, _, e in edges])},
+                   os.path.join(tmp_path, 'edges.json'), indent=None)
+        np.save(os.path.join(tmp_path, 'indptr.npy'), indptr)
+        np.save(os.path.join(tmp_path, 'indices.npy'), indices)
+        if embeddings is not None:
+            np.save(os.path.join(tmp_path, 'embeddings.npy'), embeddings)
+        replace_dir(tmp_path, dir_path)
+
+    @staticmethod
+    def read_matrix(file_path, mmap=False):
+        if os.path.exists(file_path):
+            return np.load(file_path, mmap_mode='r' if mmap else None)
+        else:
+            return None
+
+    @staticmethod
+    def write_matrix(matrix, file_path):
+        with open(file_path + '.tmp', 'wb') as f:
+            np.save(f, matrix)
+        os.replace(file_path + '.tmp', file_path)
+
+    def write_row(self, embedding, row=None):
+        embedding = np.asarray(embedding, dtype=np.float32).flatten()
+        if self.embeddings is None:
+            self.embeddings = np.zeros((16, len(embedding)), dtype=np.float32)
+        if row is None:
+            if self.size == len(self.embeddings) or not self.embeddings.flags.writeable:
+                matrix = np.zeros((max(16, 2 * self.size), self.embeddings.shape[1]), dtype=np.float32)
+                matrix[:self.size] = self.embeddings[:self.size]
+                self.embeddings = matrix
+            row, self.size = self.size, self.size + 1
+        elif not self.embeddings.flags.writeable:
+            self.embeddings = np.array(self.embeddings)
+        self.embeddings[row] = embedding
+        return row
+
+    def pack(self, attrs, old=None):
+        attrs = attrs.copy()
+        if 'embedding' in attrs:
+            attrs['row'] = self.write_row(attrs.pop('embedding'), old.get('row') if old else None)
+        if 'chunks' in attrs:
+            attrs['chunks'] = list_to_str(attrs['chunks'])
+        return attrs
+
+    def unpack(self, attrs):
+        attrs = attrs.copy()
+        if 'row' in attrs:
+            attrs['embedding'] = self.embeddings[attrs.pop('row')].copy()
+        if 'chunks' in attrs:
+            attrs['chunks'] = str_to_list(attrs['chunks'], dtype=str)
+        return attrs
 
     @staticmethod
     def read_graphml(file_path):
@@ -23,12 +177,15 @@ class NetworkXStorage(BaseGraphStorage):
 
     @staticmethod
     def write_graphml(graph, file_path):
-        nx.write_graphml(graph, file_path)
+        nx.write_graphml(graph, file_path + '.tmp')
+        os.replace(file_path + '.tmp', file_path)
 
     async def has_node(self, v):
         return self.graph.has_node(v)
 
     async def has_edge(self, e):
+        if not isinstance(e, tuple) and e not in self.ids:
+            return False
         u, v, k = e if isinstance(e, tuple) else self.ids[e]
         return self.graph.has_edge(u, v, k)
 
@@ -36,60 +193,109 @@ class NetworkXStorage(BaseGraphStorage):
         if not await self.has_node(v):
             return None
 
-        v = self.graph.nodes.get(v).copy()
-        if 'embedding' in v:
-            v['embedding'] = str_to_list(v['embedding'])
-        return v
+        return self.unpack(self.graph.nodes[v])
 
     async def get_edge(self, e):
         if not await self.has_edge(e):
             return None
 
         u, v, k = e if isinstance(e, tuple) else self.ids[e]
-        e = self.graph.edges.get((u, v, k)).copy()
-        if 'embedding' in e:
-            e['embedding'] = str_to_list(e['embedding'])
-        return e
+        return self.unpack(self.graph.edges[u, v, k])
 
     async def in_edges(self, v):
         if not await self.has_node(v):
             return []
 
-        res = []
-        for u, v, e in self.graph.in_edges(v, data=True):
-            e = e.copy()
-            if 'embedding' in e:
-                e['embedding'] = str_to_list(e['embedding'])
-            res.append((u,v,e))
-        return res
+        return [(u, v, self.unpack(e)) for u, v, e in self.graph.in_edges(v, data=True)]
 
     async def out_edges(self, v):
         if not await self.has_node(v):
             return []
 
-        res = []
-        for u, v, e in self.graph.out_edges(v, data=True):
-            e = e.copy()
-            if 'embedding' in e:
-                e['embedding'] = str_to_list(e['embedding'])
-            res.append((u,v,e))
-        return res
+        return [(u, v, self.unpack(e)) for u, v, e in self.graph.out_edges(v, data=True)]
 
-    async def upsert_node(self, v):
-        v = v.copy()
-        if 'embedding' in v:
-            v['embedding'] = list_to_str(v['embedding'])
+    def log(self, op, data):
+        if self.wal is None:
+            return
+        if isinstance(data, dict) and 'embedding' in data:
+            data = {**data, 'embedding': encode_vector(data['embedding'])}
+        self.wal.append(op, data)
+
+    def put_node(self, v):
+        self.adjacency = None
+        v = self.pack(v, self.graph.nodes.get(v['id']))
         self.graph.add_node(v['id'], **v)
 
-    async def upsert_edge(self, e):
-        e = e.copy()
-        if 'embedding' in e:
-            e['embedding'] = list_to_str(e['embedding'])
+    def put_edge(self, e):
+        self.adjacency = None
         if not self.ids.get(e['id']):
             self.ids[e['id']] = (e['source'], e['target'], e['id'])
         u, v, k = self.ids[e['id']]
+        e = self.pack(e, self.graph.edges[u, v, k] if self.graph.has_edge(u, v, k) else None)
         self.graph.add_edge(u, v, k, **e)
 
+    def remove_node(self, v):
+        self.adjacency = None
+        if not self.graph.has_node(v):
+            return
+
+        for u, w, k in list(self.graph.in_edges(v, keys=True)) + list(self.graph.out_edges(v, keys=True)):
+            self.ids.pop(k, None)
+        self.graph.remove_node(v)
+
+    def remove_edge(self, e):
+        self.adjacency = None
+        if not isinstance(e, tuple) and e not in self.ids:
+            return
+        u, v, k = e if isinstance(e, tuple) else self.ids[e]
+        if not self.graph.has_edge(u, v, k):
+            return
+
+        self.graph.remove_edge(u, v, k)
+        self.ids.pop(k, None)
+
+    async def upsert_node(self, v):
+        self.log('upsert_node', v)
+        self.put_node(v)
+
+    async def upsert_edge(self, e):
+        self.log('upsert_edge', e)
+        self.put_edge(e)
+
+    async def delete_node(self, v):
+        self.log('delete_node', v)
+        self.remove_node(v)
+
+    async def delete_edge(self, e):
+        self.log('delete_edge', e)
+        self.remove_edge(e)
+
+    def freeze(self):
+        if self.adjacency is None:
+            self.adjacency = Adjacency(self.graph)
+        return self.adjacency
+
+    async def neighbors(self, v):
+        adjacency = self.freeze()
+        if v not in adjacency.index:
+            return []
+
+        edges, nodes = adjacency.neighbors(adjacency.index[v])
+        return list(zip(adjacency.edge_ids[edges], adjacency.ids[nodes]))
+
+    async def expand(self, ids, hops=1):
+        adjacency = self.freeze()
+        index = np.array([adjacency.index.get(id, -1) for id in ids], dtype=np.int64)
+        sources, edges, nodes = adjacency.expand(index)
+        return (sources, adjacency.edge_ids[edges], adjacency.ids[nodes],
+                self.gather(adjacency.edge_rows[edges]), self.gather(adjacency.node_rows[nodes]))
+
+    def gather(self, rows):
+        if self.embeddings is None:
+            return np.zeros((len(rows), 0), dtype=np.float32)
+        res = np.zeros((len(rows), self.embeddings.shape[1]), dtype=np.float32)
+        res[rows >= 0] = self.embeddings[rows[rows >= 0]]
+        return res
 
     async def node_degree(self, v):
         return self.graph.degree(v) if await self.has_node(v) else 0
@@ -97,9 +303,51 @@ class NetworkXStorage(BaseGraphStorage):
     async def edge_degree(self, u, v, k):
         return await self.node_degree(u) + await self.node_degree(v)
 
-    async def save(self):
+    def snapshot(self):
+        graph = self.graph.copy()
+        objs = [v for _, v in graph.nodes(data=True) if 'row' in v] + \
+               [e for _, _, e in graph.edges(data=True) if 'row' in e]
+        if not objs:
+            return graph, None
+
+        embeddings = self.embeddings[[obj['row'] for obj in objs]]
+        for i, obj in enumerate(objs):
+            obj['row'] = i
+        return graph, embeddings
+
+    def write_snapshot(self, graph, embeddings):
         os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
-        self.write_graphml(self.graph, self.file_path)
+        if self.format == 'graphml':
+            graph.graph.pop('matrix', None)
+            if embeddings is not None:
+                graph.graph['matrix'] = f'{self.namespace}.{uuid4()}.npy'
+                self.write_matrix(embeddings, os.path.join(self.work_dir, graph.graph['matrix']))
+            self.write_graphml(graph, self.file_path)
+            for name in os.listdir(self.work_dir):
+                if name.startswith(f'{self.namespace}.') and name.endswith('.npy') and \
+                        name != graph.graph.get('matrix'):
+                    os.remove(os.path.join(self.work_dir, name))
+        else:
+            self.write_binary(graph, embeddings, self.dir_path)
+
+    async def dump(self):
+        graph, embeddings = self.snapshot()
+        await asyncio.to_thread(self.write_snapshot, graph, embeddings)
+
+    async def save(self):
+        if self.wal is not None:
+            await self.wal.checkpoint(self.dump)
+        else:
+            self.write_snapshot(*self.snapshot())
+
+    async def export_graphml(self, file_path):
+        graph = self.graph.copy()
+        graph.graph.pop('matrix', None)
+        for attrs in [v for _, v in graph.nodes(data=True)] + [e for _, _, e in graph.edges(data=True)]:
+            if 'row' in attrs:
+                attrs['embedding'] = list_to_str(self.embeddings[attrs.pop('row')])
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.write_graphml(graph, file_path)
 
 
 if __name__ == '__main__':
@@ -120,3 +368,4 @@ if __name__ == '__main__':
     print(asyncio.run(gdb.get_node('test-123')))
     print(asyncio.run(gdb.get_edge('test-666')))
     print(asyncio.run(gdb.get_edge(('test-123', 'test-456', 'test-666'))))
+    asyncio.run(gdb.save())
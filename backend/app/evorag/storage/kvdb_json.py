@@ -0,0 +1,43 @@
+import os
+
+from base import BaseKVStorage
+from utils import read_json, write_json
+
+
+class JsonKVStorage(BaseKVStorage):
+    def __init__(self, namespace, config):
+        super().__init__(namespace, config)
+        self.file_path = os.path.join(self.config.get('work_dir'), f'{self.namespace}.json')
+        self.data = read_json(self.file_path) or {}
+
+    async def all_keys(self):
+        return list(self.data.keys())
+
+    async def get(self, ids):
+        return [self.data.get(id) for id in ids]
+
+    async def filter_keys(self, ids):
+        return [id for id in ids if id not in self.data]
+
+    async def upsert(self, data):
+        self.data.update(data)
+
+    async def delete(self, ids):
+        for id in ids:
+            self.data.pop(id, None)
+
+    async def save(self):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        write_json(self.data, self.file_path)
+
+
+if __name__ == '__main__':
+    import asyncio
+
+    config = {'work_dir': 'temp'}
+
+    kvdb = JsonKVStorage('test', config)
+    asyncio.run(kvdb.upsert({'chunk-123': {'doc': 'doc-1', 'status': 'done'}}))
+
+    print(asyncio.run(kvdb.get(['chunk-123', 'chunk-456'])))
+    print(asyncio.run(kvdb.filter_keys(['chunk-123', 'chunk-456'])))
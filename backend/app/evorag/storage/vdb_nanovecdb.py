@@ -1,61 +1,349 @@
 import asyncio
+import base64
+import json
 import os
+import shutil
 
 import numpy as np
-from nano_vectordb import NanoVectorDB
 
 from base import BaseVectorStorage
-from utils import dict_to_list
+from index import IVFIndex, BM25Index
+from scheduler import get_scheduler
+from utils import dict_to_list, read_json, write_json
+from utils import to_columns, from_columns, find_dir, logger
+from wal import WriteAheadLog, encode_vector, decode_vector
 
 
 class NanoVectorDBStorage(BaseVectorStorage):
     def __init__(self, namespace, config, model):
         super().__init__(namespace, config, model)
         self.file_path = os.path.join(self.config.get('work_dir'), f'{self.namespace}.json')
-        self.client = NanoVectorDB(embedding_dim=self.config.get('embedding_dim'),
-                                   storage_file=self.file_path)
+        self.dir_path = os.path.join(self.config.get('work_dir'), self.namespace)
+        self.format = self.config.get('vector_format', 'json')
+        self.dtype = self.config.get('vector_dtype', 'float32')
+        self.read_only = self.config.get('read_only', False)
+        if self.read_only and (self.format, self.dtype) != ('npy', 'float32'):
+            raise ValueError(f'{self.namespace}只读模式需要float32的npy格式以共享内存映射, '
+                             f'当前为{self.dtype}的{self.format}格式')
+        self.version, self.version_mtime = None, None
+
+        self.embedding_dim = self.config.get('embedding_dim')
+        storage = self.read_snapshot(self.dir_path, mmap=self.read_only) if self.format == 'npy' else None
+        self.storage = storage or self.read_json_snapshot(self.file_path) or {
+            'embedding_dim': self.embedding_dim, 'data': [],
+            'matrix': np.zeros((0, self.embedding_dim), dtype=np.float32)}
+        if self.storage['embedding_dim'] != self.embedding_dim:
+            raise ValueError(f'{self.namespace}向量维度不匹配: 期望{self.embedding_dim}, 实际{self.storage["embedding_dim"]}')
 
         self.similarity_threshold = self.config.get('similarity_threshold')
         self.max_batch_size = self.config.get('max_batch_size')
 
+        self.index = None
+        if self.config.get('vector_index') == 'ivf':
+            self.index = IVFIndex(nlist=self.config.get('ivf_nlist'),
+                                  nprobe=self.config.get('ivf_nprobe', 8),
+                                  min_size=self.config.get('ivf_min_size', 20000))
+
+        self.keyword_fields = self.config.get('keyword_fields', ['name', 'desc'])
+        self.keyword_weight = self.config.get('keyword_weight', 0.3)
+        self.fields, self.bm25 = {}, None
+
+        self.wal = None
+        if self.config.get('wal') and not self.read_only:
+            self.wal = WriteAheadLog(os.path.join(self.config.get('work_dir'), f'{self.namespace}.wal'),
+                                     self.config.get('wal_compact_size', 64 << 20))
+            for op, data in self.wal.replay():
+                if op == 'upsert':
+                    self.upsert_rows([{**i, '__vector__': decode_vector(i['__vector__'])} for i in data])
+                elif op == 'delete':
+                    self.delete_rows(data)
+
+        for obj in self.storage['data']:
+            if 'embedding' in obj:
+                obj['__norm__'] = float(np.linalg.norm(obj.pop('embedding')))
+
+    @staticmethod
+    def norm(vector):
+        return float(np.linalg.norm(np.asarray(vector, dtype=np.float32)))
+
+    @staticmethod
+    def normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def upsert_rows(self, data):
+        data_list, matrix = self.storage['data'], self.storage['matrix']
+        positions = {obj['__id__']: i for i, obj in enumerate(data_list)}
+        update, insert, rows, vectors = [], [], [], []
+        for obj in data:
+            vector = np.asarray(obj['__vector__'], dtype=np.float32)
+            obj = {k: v for k, v in obj.items() if k != '__vector__'}
+            if obj['__id__'] in positions:
+                i = positions[obj['__id__']]
+                if i < len(data_list):
+                    update.append(obj['__id__'])
+                    data_list[i] = obj
+                    matrix[i] = self.normalize(vector)
+                else:
+                    rows[i - len(data_list)], vectors[i - len(data_list)] = obj, vector
+            else:
+                insert.append(obj['__id__'])
+                positions[obj['__id__']] = len(data_list) + len(rows)
+                rows.append(obj)
+                vectors.append(vector)
+
+        if rows:
+            data_list.extend(rows)
+            self.storage['matrix'] = np.vstack([matrix, self.normalize(np.stack(vectors))])
+        return update, insert
+
+    def delete_rows(self, ids):
+        ids = set(ids)
+        keep = [i for i, obj in enumerate(self.storage['data']) if obj['__id__'] not in ids]
+        if len(keep) == len(self.storage['data']):
+            return
+        self.storage['data'] = [self.storage['data'][i] for i in keep]
+        self.storage['matrix'] = self.storage['matrix'][keep]
+
+    def check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f'{self.namespace}为只读存储')
+
+    def refresh(self):
+        if not self.read_only or self.format != 'npy':
+            return
+        try:
+            mtime = os.stat(os.path.join(self.dir_path, 'CURRENT')).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.version_mtime:
+            return
+
+        version, self.version_mtime = self.read_version(self.dir_path)
+        if version == self.version:
+            return
+
+        storage = self.read_snapshot(self.dir_path, mmap=True)
+        if storage is not None:
+            self.storage = storage
+            self.fields, self.bm25 = {}, None
+            if self.index is not None:
+                self.index.reset()
+            logger.info(f'{self.namespace}切换到版本{self.version}')
 
     async def get(self, ids):
-        res = self.client.get(ids)
-        res = [{'id': i['__id__'], **{k: v for k, v in i.items() if k != '__id__'}} for i in res]
+        self.refresh()
+        storage, ids = self.storage, set(ids)
+        res = [{'id': obj['__id__'], **{k: v for k, v in obj.items() if k not in ['__id__', '__norm__']},
+                'embedding': storage['matrix'][i] * obj.get('__norm__', 1.0)}
+               for i, obj in enumerate(storage['data']) if obj['__id__'] in ids]
         return res
 
 
     async def upsert(self, data):
+        self.check_writable()
         data = dict_to_list(data) if isinstance(data, dict) else data
         if 'embedding' in next(iter(data)):
-            data = [{'__id__': i['id'], '__vector__': i['embedding'], 'embedding': i['embedding'].tolist(),
+            data = [{'__id__': i['id'], '__vector__': i['embedding'], '__norm__': self.norm(i['embedding']),
                      **{k: v for k, v in i.items() if k not in ('id', 'embedding')}} for i in data]
         else:
             contents = [i['content'] for i in data]
             batches = [contents[i: i + self.max_batch_size] for i in range(0, len(contents), self.max_batch_size)]
-            embeddings = await asyncio.gather(*[self.model(i) for i in batches])
+            embeddings = await asyncio.gather(*[self.model(i, scheduler=get_scheduler()) for i in batches])
             embeddings = np.concatenate(embeddings)
-            data = [{'__id__': i['id'], '__vector__': embeddings[i], **{k: v for k, v in i.items()}} for i in data]
+            data = [{'__id__': i['id'], '__vector__': embeddings[j], '__norm__': self.norm(embeddings[j]),
+                     **{k: v for k, v in i.items()}} for j, i in enumerate(data)]
+
+        if self.wal is not None:
+            self.wal.append('upsert', [{**i, '__vector__': encode_vector(i['__vector__'])} for i in data])
+        update, insert = self.upsert_rows(data)
+        self.fields, self.bm25 = {}, None
+        if self.index is not None and update:
+            ids = set(update)
+            self.index.update(i for i, obj in enumerate(self.storage['data']) if obj['__id__'] in ids)
+        return update, insert
+
+    async def delete(self, ids):
+        self.check_writable()
+        if self.wal is not None:
+            self.wal.append('delete', list(ids))
+        self.delete_rows(ids)
+        self.fields, self.bm25 = {}, None
+        if self.index is not None:
+            self.index.reset()
 
-        res = self.client.upsert(data)
-        return res['update'], res['insert']
+    async def query(self, query, top_k=5, threshold=None, where=None, keywords=None):
+        return (await self.query_batch([query], top_k, threshold, where,
+                                       None if keywords is None else [keywords]))[0]
 
-    async def query(self, query, top_k=5, threshold=None):
-        if isinstance(query, str):
-            query = await self.model(query)
-            query = query[0]
+    async def query_batch(self, queries, top_k=5, threshold=None, where=None, keywords=None):
+        self.refresh()
+        if queries and isinstance(queries[0], str):
+            queries = await self.model(queries, scheduler=get_scheduler())
         if threshold is None:
             threshold = self.similarity_threshold
 
-        res = self.client.query(query, top_k, threshold)
-        res = [{'id': i['__id__'], 'metrics': i['__metrics__'],
-                **{k: v for k, v in i.items() if k not in ['__id__', '__metrics__', 'embedding']}} for i in res]
+        matrix, data = self.storage['matrix'], self.storage['data']
+        if not len(queries) or not len(data):
+            return [[] for _ in range(len(queries))]
+
+        queries = self.normalize(np.asarray(queries, dtype=np.float32).reshape(len(queries), -1))
+        res = []
+        if where or keywords:
+            matches = self.filtered_search(matrix, queries, top_k, where, keywords)
+        else:
+            matches = self.search(matrix, queries, top_k)
+        for row_index, row_scores in matches:
+            res.append([self.format_match(data[i], score) for i, score in zip(row_index, row_scores)
+                        if threshold is None or score >= threshold])
         return res
 
-    async def save(self):
+    def search(self, matrix, queries, top_k):
+        if self.index is not None:
+            res = self.index.search(matrix, queries, top_k)
+            if res is not None:
+                return res
+
+        return self.top(queries @ matrix.T, top_k)
+
+    @staticmethod
+    def top(scores, top_k):
+        top_k = min(top_k, scores.shape[1])
+        if not top_k:
+            return [(np.array([], dtype=np.int64), np.array([], dtype=np.float32)) for _ in range(len(scores))]
+        index = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        top = np.take_along_axis(scores, index, axis=1)
+        order = np.argsort(-top, axis=1)
+        return zip(np.take_along_axis(index, order, axis=1), np.take_along_axis(top, order, axis=1))
+
+    async def find(self, where):
+        self.refresh()
+        data = self.storage['data']
+        return [data[i]['__id__'] for i in self.filter_rows(where)]
+
+    def filter_rows(self, where):
+        data = self.storage['data']
+        rows = None
+        for field, values in where.items():
+            field = '__id__' if field == 'id' else field
+            if field not in self.fields:
+                postings = {}
+                for i, obj in enumerate(data):
+                    value = obj.get(field)
+                    for v in value if isinstance(value, list) else [value]:
+                        if isinstance(v, (str, int, float, bool)):
+                            postings.setdefault(v, []).append(i)
+                self.fields[field] = {v: np.array(i, dtype=np.int64) for v, i in postings.items()}
+
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            hits = [self.fields[field][v] for v in values if v in self.fields[field]]
+            hits = np.unique(np.concatenate(hits)) if hits else np.array([], dtype=np.int64)
+            rows = hits if rows is None else np.intersect1d(rows, hits, assume_unique=True)
+        return rows
+
+    def keyword_scores(self, keywords):
+        if self.bm25 is None:
+            data = self.storage['data']
+            self.bm25 = BM25Index([' '.join(str(obj.get(k, '')) for k in self.keyword_fields) for obj in data])
+        scores = self.bm25.score(keywords)
+        return scores / scores.max() if scores.max() > 0 else scores
+
+    def filtered_search(self, matrix, queries, top_k, where=None, keywords=None):
+        rows = self.filter_rows(where) if where else np.arange(len(matrix))
+        scores = queries @ matrix[rows].T
+        if keywords:
+            keywords = np.stack([self.keyword_scores(i)[rows] for i in keywords])
+            scores = (1 - self.keyword_weight) * scores + self.keyword_weight * keywords
+        return [(rows[index], top) for index, top in self.top(scores, top_k)]
+
+    @staticmethod
+    def format_match(data, metrics):
+        return {'id': data['__id__'], 'metrics': float(metrics),
+                **{k: v for k, v in data.items() if k not in ['__id__', '__metrics__', '__norm__', 'embedding']}}
+
+    @staticmethod
+    def read_version(dir_path):
+        pointer = os.path.join(dir_path, 'CURRENT')
+        if not os.path.exists(pointer):
+            return None, None
+        with open(pointer, encoding='utf-8') as f:
+            return f.read().strip(), os.stat(pointer).st_mtime_ns
+
+    @staticmethod
+    def write_version(dir_path, version):
+        pointer = os.path.join(dir_path, 'CURRENT')
+        with open(pointer + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(pointer + '.tmp', pointer)
+
+    @staticmethod
+    def read_json_snapshot(file_path):
+        if not os.path.exists(file_path):
+            return None
+        storage = read_json(file_path)
+        matrix = np.frombuffer(base64.b64decode(storage['matrix']), dtype=np.float32)
+        storage['matrix'] = NanoVectorDBStorage.normalize(matrix.reshape(-1, storage['embedding_dim']))
+        return storage
+
+    def read_snapshot(self, dir_path, mmap=False):
+        version, mtime = self.read_version(dir_path)
+        path = os.path.join(dir_path, version) if version else find_dir(dir_path, 'meta.json')
+        if path is None:
+            return None
+
+        meta = read_json(os.path.join(path, 'meta.json'))
+        if mmap and meta['dtype'] != 'float32':
+            raise ValueError(f'{self.namespace}只读模式无法映射{meta["dtype"]}快照, 写入端需使用float32')
+        matrix = np.load(os.path.join(path, 'matrix.npy'), mmap_mode='r' if mmap else None)
+        if meta['dtype'] != 'float32':
+            matrix = matrix.astype(np.float32)
+        if meta['dtype'] == 'int8':
+            matrix *= np.load(os.path.join(path, 'scales.npy'))[:, None]
+        self.version, self.version_mtime = version, mtime
+        return {'embedding_dim': meta['embedding_dim'], 'data': from_columns(meta),
+                'matrix': matrix.reshape(-1, meta['embedding_dim'])}
+
+    def write_snapshot(self, storage):
         os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
-        self.client.save()
+        if self.format != 'npy':
+            with open(self.file_path + '.tmp', 'w', encoding='utf-8') as f:
+                matrix = base64.b64encode(np.asarray(storage['matrix'], dtype=np.float32).tobytes()).decode()
+                json.dump({**storage, 'matrix': matrix}, f, ensure_ascii=False)
+            os.replace(self.file_path + '.tmp', self.file_path)
+            return
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        version = str(int(self.read_version(self.dir_path)[0] or 0) + 1)
+        tmp_path = os.path.join(self.dir_path, version + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        matrix = storage['matrix']
+        if self.dtype == 'int8':
+            scales = np.abs(matrix).max(axis=1, initial=0) / 127
+            scales[scales == 0] = 1
+            np.save(os.path.join(tmp_path, 'scales.npy'), scales.astype(np.float32))
+            matrix = np.round(matrix / scales[:, None]).astype(np.int8)
+        np.save(os.path.join(tmp_path, 'matrix.npy'), matrix.astype(self.dtype))
+        write_json({'embedding_dim': storage['embedding_dim'], 'dtype': self.dtype, **to_columns(storage['data'])},
+                   os.path.join(tmp_path, 'meta.json'), indent=None)
+        os.replace(tmp_path, os.path.join(self.dir_path, version))
+        self.write_version(self.dir_path, version)
 
+        for name in os.listdir(self.dir_path):
+            if name.isdigit() and int(name) < int(version) - 1:
+                shutil.rmtree(os.path.join(self.dir_path, name), ignore_errors=True)
+
+    async def dump(self):
+        storage = self.storage
+        storage = {**storage, 'data': list(storage['data']), 'matrix': storage['matrix'].copy()}
+        await asyncio.to_thread(self.write_snapshot, storage)
+
+    async def save(self):
+        self.check_writable()
+        if self.wal is not None:
+            await self.wal.checkpoint(self.dump)
+        else:
+            self.write_snapshot(self.storage)
 
 if __name__ == '__main__':
     from dotenv import load_dotenv
@@ -74,4 +362,6 @@ if __name__ == '__main__':
 
     print(asyncio.run(vdb.upsert(data)))
     print(asyncio.run(vdb.query('Hello', top_k=2, threshold=0.1)))
+    print(asyncio.run(vdb.query_batch(['Hello', 'World'], top_k=1, threshold=0.1)))
+    print(asyncio.run(vdb.query('Hello', top_k=2, threshold=0.1, where={'name': 'banana'}, keywords='banana')))
     print(asyncio.run(vdb.get(['test-123', 'test-456'])))
@@ -1,8 +1,8 @@
-import asyncio
 import hashlib
 import json
 import logging
 import os
+import shutil
 import uuid
 
 import numpy as np
@@ -12,7 +12,6 @@ logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger()
 tokenizer = tiktoken.encoding_for_model('gpt-4o')
-lock1, lock2 = asyncio.Lock(), asyncio.Lock()
 
 AwaitNone = type('AwaitableNone', (),
                  {'__await__': lambda self: iter(()),
@@ -26,9 +25,42 @@ def read_json(file_path):
         return json.load(f)
 
 
-def write_json(json_obj, file_path):
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(json_obj, f, indent=2, ensure_ascii=False)
+def read_blocks(file_path, block_size=1 << 20):
+    with open(file_path, encoding="utf-8") as f:
+        while block := f.read(block_size):
+            yield block
+
+
+def write_json(json_obj, file_path, indent=2):
+    with open(file_path + '.tmp', "w", encoding="utf-8") as f:
+        json.dump(json_obj, f, indent=indent, ensure_ascii=False)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def to_columns(objs):
+    keys = list(dict.fromkeys(k for obj in objs for k in obj))
+    return {'count': len(objs), 'columns': {k: [obj.get(k) for obj in objs] for k in keys}}
+
+
+def from_columns(table):
+    return [{k: column[i] for k, column in table['columns'].items() if column[i] is not None}
+            for i in range(table['count'])]
+
+
+def find_dir(dir_path, file_name):
+    for path in [dir_path, dir_path + '.old']:
+        if os.path.exists(os.path.join(path, file_name)):
+            return path
+    return None
+
+
+def replace_dir(tmp_path, dir_path):
+    old_path = dir_path + '.old'
+    if os.path.exists(dir_path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(dir_path, old_path)
+    os.replace(tmp_path, dir_path)
+    shutil.rmtree(old_path, ignore_errors=True)
 
 
 def list_to_dict(objs, key='id'):
@@ -69,7 +101,35 @@ def cosine_similarity(vec1, vec2):
     return np.dot(vec1, vec2) / (norm1 * norm2) if norm1 != 0 and norm2 != 0 else 0.0
 
 
+def similarity_groups(embeddings, threshold, keys=None):
+    if not len(embeddings):
+        return []
+    matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    matrix = matrix / np.where(norms == 0, 1, norms)
+    mask = np.triu(matrix @ matrix.T >= threshold, k=1)
+    if keys is not None:
+        index = {}
+        keys = np.array([index.setdefault(key, len(index)) for key in keys])
+        mask &= keys[:, None] == keys[None, :]
+
+    groups = list(range(len(matrix)))
+
+    def find(i):
+        while groups[i] != i:
+            groups[i] = groups[groups[i]]
+            i = groups[i]
+        return i
+
+    for i, j in zip(*np.nonzero(mask)):
+        i, j = find(i), find(j)
+        if i != j:
+            groups[max(i, j)] = min(i, j)
+    return [find(i) for i in range(len(groups))]
+
+
 if __name__ == '__main__':
     print(md5('Hello, World!', salt='GXU', prefix='test'))
     print(create_message('Hello, World!', 'Hello, World!'))
     print(cosine_similarity(np.array([1, 2, 3]), np.array([[1, 2, 3]])))
+    print(similarity_groups(np.array([[1, 0], [0.99, 0.1], [0, 1]]), threshold=0.9))
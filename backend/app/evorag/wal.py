@@ -0,0 +1,93 @@
+import asyncio
+import base64
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def encode_vector(vector):
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+
+
+def decode_vector(text):
+    return np.frombuffer(base64.b64decode(text), dtype=np.float32)
+
+
+class WriteAheadLog:
+    def __init__(self, file_path, compact_size=64 << 20):
+        self.file_path = file_path
+        self.old_path = file_path + '.old'
+        self.compact_size = compact_size
+        self.file = None
+        self.compaction = None
+
+    def replay(self):
+        for path in [self.old_path, self.file_path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    yield record['op'], record['data']
+
+    def append(self, op, data):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self.file = open(self.file_path, 'a+', encoding='utf-8')
+            if self.file.tell() > 0:
+                self.file.seek(self.file.tell() - 1)
+                if self.file.read(1) != '\n':
+                    self.file.write('\n')
+        record = json.dumps({'op': op, 'data': data}, ensure_ascii=False,
+                            default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o))
+        self.file.write(record + '\n')
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def rotate(self):
+        self.close()
+        if not os.path.exists(self.file_path):
+            return
+        if os.path.exists(self.old_path):
+            with open(self.old_path, 'a', encoding='utf-8') as old, open(self.file_path, encoding='utf-8') as f:
+                shutil.copyfileobj(f, old)
+            os.remove(self.file_path)
+        else:
+            os.replace(self.file_path, self.old_path)
+
+    async def checkpoint(self, dump):
+        self.flush()
+        size = os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+        pending = size >= self.compact_size or os.path.exists(self.old_path)
+        if pending and (self.compaction is None or self.compaction.done()):
+            self.compaction = asyncio.create_task(self.compact(dump))
+
+    async def compact(self, dump):
+        self.rotate()
+        await dump()
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+
+if __name__ == '__main__':
+    wal = WriteAheadLog(os.path.join('temp', 'test.wal'))
+    wal.append('upsert', {'id': 'test-123', 'embedding': encode_vector([1, 2, 3])})
+    wal.append('delete', ['test-456'])
+    wal.flush()
+
+    for op, data in wal.replay():
+        print(op, data)
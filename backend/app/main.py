@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.api.v1.endpoints import users, admin, system, chat, auth
 from app.core.config import settings
 from app.db.database import init_mysql
+from app.evorag.model import close_openai_async_clients, close_model_caches
 
 app = FastAPI(
     title="KGLLM",
@@ -46,6 +47,11 @@ app.add_middleware(
 async def startup_event():
     init_mysql()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_openai_async_clients()
+    close_model_caches()
+
 # 包含路由
 app.include_router(
     auth.router,